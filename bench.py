@@ -0,0 +1,1245 @@
+# bench.py
+# オフラインのベンチマーク (Discord に接続せずに bot.py のホットパスを測る)
+#   python bench.py vote        # 1 投票あたりのコスト (投票者数を増やしても一定か)
+#   python bench.py guilds      # サーバー数を増やしたときの Step1~3 の所要時間
+#   python bench.py reminders   # Step3 のリマインド送信数 (per_date と digest の比較)
+#   python bench.py status      # Step2 の投票状況通知の送信数 (初回と定常状態)
+#   python bench.py compact     # 投票データのメモリ量と votes.json のサイズ (旧形式と新形式)
+#   python bench.py load        # Step1 -> 投票 (+人数確定通知) -> Step2 -> Step3 を流して
+#                               # ハンドラの p50/p99・イベントループの停止時間・data/ への書き込み量・API 呼び出し数を出す
+#   python bench.py actors      # 同じメッセージへの同時クリック: スループットと最終 Embed が最終状態と一致するか
+#   python bench.py waiters     # 画像待ちの人数ごとの 1 メッセージあたりの処理コスト (wait_for と待ち受け表)
+#   python bench.py step1       # Step1 の所要時間と API 呼び出し数 (級の並行化・再実行・途中再開)
+#   python bench.py rollups     # /stats の集計: 全履歴を走査する場合と差分集計を引く場合の比較
+#   python bench.py index       # 1 年分の履歴で、対象メッセージを全走査で探す場合と索引で引く場合の比較
+#   python bench.py replay      # 記録した操作トレース (TRACE_FILE) を 1x~100x で再生してハンドラの遅延とスループットを出す
+import io
+import os
+import sys
+import json
+import contextlib
+import time
+import datetime
+import asyncio
+import random
+import argparse
+import itertools
+import tempfile
+import tracemalloc
+
+import discord
+
+# bot.py は import 時に ./data を作るので、一時ディレクトリで読み込む。
+# レート制限はフェイク API の遅延で代用するので、送信キューのバケットは実質無制限にしておく
+os.environ.setdefault("OUTBOUND_ROUTE_RATE", "1000000")
+os.environ.setdefault("OUTBOUND_GLOBAL_RATE", "1000000")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(tempfile.mkdtemp(prefix="bench-"))
+
+import bot  # noqa: E402
+
+
+def fmt_us(sec):
+    return f"{sec * 1e6:8.2f} us"
+
+# -----------------------------
+# フェイク Discord オブジェクト
+# bot.py が使う属性・メソッドだけを持つ。API 呼び出しは FakeAPI で数えて遅延を入れる
+# -----------------------------
+_ids = itertools.count(10 ** 17)
+
+
+class FakeUser:
+    def __init__(self, name):
+        self.id = next(_ids)
+        self.name = self.display_name = name
+        self.bot = True
+
+
+BOT_USER = FakeUser("darbuka")    # bot 自身 (bot.user)
+
+
+class FakeAPI:
+    def __init__(self, latency=0.0, jitter=0.0, rng=None):
+        self.latency = latency
+        self.jitter = jitter      # 遅延を latency * (1 ± jitter) でばらつかせる (完了順が入れ替わる)
+        self.rng = rng or random.Random(0)
+        self.calls = {}
+
+    async def call(self, kind):
+        self.calls[kind] = self.calls.get(kind, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency * (1 + self.jitter * self.rng.uniform(-1, 1)))
+        else:
+            await asyncio.sleep(0)
+
+    def total(self):
+        return sum(self.calls.values())
+
+
+class FakePermissions:
+    def __init__(self, allowed):
+        self.read_messages = allowed
+        self.view_channel = allowed
+        self.administrator = False
+
+
+class FakeRole:
+    def __init__(self, guild, name):
+        self.id = next(_ids)
+        self.guild = guild
+        self.name = name
+        self.mention = f"<@&{self.id}>"
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __eq__(self, other):
+        return isinstance(other, FakeRole) and other.id == self.id
+
+
+class FakeMember:
+    def __init__(self, guild, name, roles=(), is_bot=False):
+        self.id = next(_ids)
+        self.guild = guild
+        self.name = self.display_name = name
+        self.bot = is_bot
+        self.roles = [guild.default_role, *roles]
+        self.mention = f"<@{self.id}>"
+        self.guild_permissions = FakePermissions(False)
+
+
+class FakeMessage:
+    def __init__(self, channel, content=None, embed=None, view=None, author=None):
+        self.id = next(_ids)
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.embed = embed
+        self.view = view
+        self.attachments = []
+
+    @property
+    def embeds(self):
+        return [self.embed] if self.embed else []
+
+
+class FakeChannel:
+    def __init__(self, guild, name, category=None, overwrites=None):
+        self.id = next(_ids)
+        self.guild = guild
+        self.name = name
+        self.category = category
+        self.category_id = category.id if category else None
+        self.overwrites = overwrites or {}
+        self.messages = []
+        self.fail_after = None    # 数値なら、その件数だけ送った後の send を失敗させる
+
+    def permissions_for(self, member):
+        # 簡略版: 上書きが無ければ全員、あれば view_channel=True のロールを持つ人だけ
+        if not self.overwrites:
+            return FakePermissions(True)
+        allowed = any(ow.view_channel for role, ow in self.overwrites.items() if role in member.roles)
+        return FakePermissions(allowed)
+
+    @property
+    def members(self):
+        return [m for m in self.guild.members if self.permissions_for(m).read_messages]
+
+    async def send(self, content=None, embed=None, view=None):
+        await self.guild.api.call("send")
+        if self.fail_after is not None:
+            if self.fail_after <= 0:
+                raise RuntimeError("fake send failure")
+            self.fail_after -= 1
+        msg = FakeMessage(self, content, embed, view, author=BOT_USER)
+        self.messages.append(msg)
+        return msg
+
+    async def history(self, limit=100):
+        await self.guild.api.call("history")
+        for msg in reversed(self.messages[-limit:]):
+            yield msg
+
+    async def edit(self, overwrites=None):
+        await self.guild.api.call("channel_edit")
+        if overwrites is not None:
+            self.overwrites = overwrites
+
+
+class FakeCategory:
+    def __init__(self, guild, name):
+        self.id = next(_ids)
+        self.guild = guild
+        self.name = name
+
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.done = False
+
+    def is_done(self):
+        return self.done
+
+    async def edit_message(self, embed=None, view=None):
+        await self.interaction.guild.api.call("interaction")
+        self.done = True
+        self.interaction.message.embed = embed
+
+    async def defer(self, ephemeral=False):
+        await self.interaction.guild.api.call("interaction")
+        self.done = True
+
+    async def send_message(self, content=None, embed=None, view=None, ephemeral=False):
+        await self.interaction.guild.api.call("interaction")
+        self.done = True
+
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, embed=None, view=None, ephemeral=False):
+        await self.interaction.guild.api.call("followup")
+
+
+class FakeInteraction:
+    def __init__(self, message, user, channel=None):
+        # スラッシュコマンドは message なしで channel を渡す
+        self.id = next(_ids)
+        self.message = message
+        self.channel = channel or message.channel
+        self.guild = self.channel.guild
+        self.user = user
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+
+    async def edit_original_response(self, embed=None, view=None):
+        await self.guild.api.call("interaction_edit")
+        self.message.embed = embed
+
+
+class FakeGuild:
+    registry = {}     # channel_id -> FakeChannel (bot.get_channel の代わり)
+
+    def __init__(self, api, name="guild", members=50, levels=("初級", "中級")):
+        self.id = next(_ids)
+        self.api = api
+        self.name = name
+        self.default_role = FakeRole(self, "@everyone")
+        self.roles = [self.default_role] + [FakeRole(self, n) for n in ("講師", "管理者", *levels)]
+        self.categories = [FakeCategory(self, n) for n in levels]
+        self.text_channels = []
+        self.members = []
+        role = {r.name: r for r in self.roles}
+        self.members.append(FakeMember(self, "teacher", [role["講師"]]))
+        self.members.append(FakeMember(self, "bot", is_bot=True))
+        for i in range(members):
+            self.members.append(FakeMember(self, f"member{i}", [role[levels[i % len(levels)]]]))
+
+    @property
+    def channels(self):
+        return list(self.text_channels)
+
+    def get_channel(self, channel_id):
+        ch = self.registry.get(channel_id)
+        return ch if ch is not None and ch.guild is self else None
+
+    async def create_text_channel(self, name, category=None, overwrites=None):
+        await self.api.call("create_channel")
+        ch = FakeChannel(self, name, category, overwrites)
+        self.text_channels.append(ch)
+        self.registry[ch.id] = ch
+        return ch
+
+
+def install_fakes(guilds=()):
+    # bot の接続まわりをフェイクに差し替える (guilds は bot.guilds として見える)
+    async def ready():
+        return None
+    bot.bot.wait_until_ready = ready
+    bot.bot.get_channel = FakeGuild.registry.get
+    bot.bot._connection._guilds = {g.id: g for g in guilds}
+    bot.bot._connection.user = BOT_USER
+
+
+def reset_state():
+    bot.vote_data.clear()
+    bot.vote_index.rebuild(bot.vote_data)
+    bot.user_names.clear()
+    bot.confirmed.clear()
+    bot.attendance_base = bot.AttendanceRollup()
+    bot.attendance = bot.AttendanceRollup()
+    bot.eligible_voters.channels.clear()
+    FakeGuild.registry.clear()
+
+# -----------------------------
+# 投票トグル
+# -----------------------------
+
+def legacy_toggle(buckets, user_id, status, user_name):
+    # 以前の handle_vote と同じ走査方式 (比較用)
+    current_status = None
+    for k, v in buckets.items():
+        if user_id in v:
+            current_status = k
+            break
+    if current_status == status:
+        del buckets[status][user_id]
+    else:
+        for v_dict in buckets.values():
+            if user_id in v_dict:
+                del v_dict[user_id]
+        buckets[status][user_id] = user_name
+    return sum(len(v) for v in buckets.values())
+
+
+def bench_vote(args):
+    print(f"{'voters':>8} {'legacy/vote':>12} {'record/vote':>12}")
+    for n in args.voters:
+        legacy = {s: {} for s in bot.STATUSES}
+        for i in range(n):
+            legacy[bot.STATUSES[i % 3]][str(i)] = f"user{i}"
+        rec = bot.VoteRecord({str(i): i % 3 for i in range(n)})
+        users = [str(i % n) for i in range(args.iterations)]
+
+        t0 = time.perf_counter()
+        for i, uid in enumerate(users):
+            legacy_toggle(legacy, uid, bot.STATUSES[i % 3], "x")
+        t_legacy = (time.perf_counter() - t0) / args.iterations
+
+        t0 = time.perf_counter()
+        for i, uid in enumerate(users):
+            rec.toggle(uid, i % 3)
+            rec.counts[bot.YES]
+        t_record = (time.perf_counter() - t0) / args.iterations
+        print(f"{n:>8} {fmt_us(t_legacy):>12} {fmt_us(t_record):>12}")
+
+
+# -----------------------------
+# 複数サーバー
+# -----------------------------
+
+def bench_guilds(args):
+    install_fakes()
+
+    async def run(n):
+        reset_state()
+        api = FakeAPI(args.latency)
+        guilds = [FakeGuild(api, f"guild{i}", members=args.members) for i in range(n)]
+        result = {}
+        for name, step in (("step1", bot.step1_for_guild), ("step2", bot.step2_for_guild), ("step3", bot.step3_for_guild)):
+            t0 = time.perf_counter()
+            await bot.run_per_guild(step, guilds)
+            result[name] = time.perf_counter() - t0
+        return result, api.total()
+
+    print(f"GUILD_CONCURRENCY={bot.GUILD_CONCURRENCY}  latency={args.latency * 1000:.0f}ms  members={args.members}")
+    print(f"{'guilds':>7} {'step1':>9} {'step2':>9} {'step3':>9} {'api calls':>10}")
+    for n in args.guilds:
+        result, calls = asyncio.run(run(n))
+        print(f"{n:>7} {result['step1']:>8.3f}s {result['step2']:>8.3f}s {result['step3']:>8.3f}s {calls:>10}")
+
+
+# -----------------------------
+# Step3 リマインド
+# -----------------------------
+
+def cast_random_votes(guild, rate, rng):
+    # メンバーの rate の割合が「投票する人」で、その人は各日程に 9 割の確率で投票する。残りは全く投票しない
+    for ch in guild.text_channels:
+        voters = [m for m in ch.members if not m.bot and rng.random() < rate]
+        for msg in ch.messages:
+            if msg.view is None:
+                continue
+            date_str = msg.view.date_str
+            rec = bot.get_vote_record(str(msg.id), date_str)
+            for m in voters:
+                if rng.random() < 0.9:
+                    bot.user_names[str(m.id)] = m.display_name
+                    rec.toggle(str(m.id), rng.randrange(len(bot.STATUSES)))
+
+
+def bench_reminders(args):
+    install_fakes()
+
+    async def run(mode):
+        reset_state()
+        bot.REMINDER_MODE = mode
+        api = FakeAPI()
+        guild = FakeGuild(api, members=args.members)
+        await bot.step1_for_guild(guild)
+        cast_random_votes(guild, args.vote_rate, random.Random(1))
+        before = api.calls.get("send", 0)
+        longest = 0
+        await bot.step3_for_guild(guild)
+        for ch in guild.text_channels:
+            for msg in ch.messages:
+                if msg.content:
+                    longest = max(longest, len(msg.content))
+        return api.calls.get("send", 0) - before, longest
+
+    print(f"members={args.members}  vote_rate={args.vote_rate}  channels=2 x 7 dates")
+    print(f"{'mode':>9} {'messages':>9} {'longest':>8}")
+    for mode in ("per_date", "digest"):
+        sent, longest = asyncio.run(run(mode))
+        print(f"{mode:>9} {sent:>9} {longest:>8}")
+
+
+# -----------------------------
+# Step2 投票状況通知
+# -----------------------------
+
+def bench_status(args):
+    install_fakes()
+
+    async def run():
+        reset_state()
+        bot.digest_versions.clear()
+        api = FakeAPI()
+        guild = FakeGuild(api, members=args.members)
+        await bot.step1_for_guild(guild)
+        rng = random.Random(1)
+        cast_random_votes(guild, 0.5, rng)
+        rows = []
+        for label in ("初回", "定常 (変更少)", "変更なし"):
+            if label == "定常 (変更少)":
+                # 2 日程だけ誰かが投票を変えた
+                for ch in guild.text_channels[:1]:
+                    for msg in ch.messages[:2]:
+                        rec = bot.get_vote_record(str(msg.id), msg.view.date_str)
+                        rec.toggle("1", bot.YES)
+            seen = {ch.id: len(ch.messages) for ch in guild.text_channels}
+            await bot.step2_for_guild(guild)
+            new = [m for ch in guild.text_channels for m in ch.messages[seen[ch.id]:]]
+            rows.append((label, len(new), sum(len(m.embed.fields) for m in new if m.embed)))
+        return rows
+
+    print(f"members={args.members}  channels=2 x 7 dates  (以前の方式は毎回 14 メッセージ x 4 フィールド)")
+    print(f"{'run':<14} {'messages':>9} {'fields':>7}")
+    for label, sent, fields in asyncio.run(run()):
+        print(f"{label:<14} {sent:>9} {fields:>7}")
+
+
+# -----------------------------
+# 投票データの表現 (旧形式と新形式)
+# -----------------------------
+
+def synthetic_history(weeks, members, vote_rate, rng):
+    # 旧形式の vote_data: 週ごとに 2 チャンネル x 7 日程、各メンバーは vote_rate の確率で投票する
+    names = {str(10 ** 17 + i): f"受講生{i:04d} (ダルブッカ)" for i in range(members)}
+    data = {}
+    msg_ids = itertools.count(10 ** 18)
+    for w in range(weeks):
+        for ch in (1, 2):
+            for d in range(7):
+                buckets = {s: {} for s in bot.STATUSES}
+                for uid, name in names.items():
+                    if rng.random() < vote_rate:
+                        buckets[rng.choice(bot.STATUSES)][uid] = name
+                date = datetime.date(2025, 1, 5) + datetime.timedelta(weeks=w, days=d)
+                data[str(next(msg_ids))] = {"channel": ch, "guild": 1, f"{date.isoformat()} (曜)": buckets}
+    return data
+
+
+def measure_load(load):
+    tracemalloc.start()
+    obj = load()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return obj, size
+
+
+def bench_compact(args):
+    print(f"members={args.members}  vote_rate={args.vote_rate}  (1 週 = 2 チャンネル x 7 日程)")
+    print(f"{'weeks':>6} {'old memory':>11} {'new memory':>11} {'old file':>10} {'new file':>10}")
+    for weeks in args.weeks:
+        legacy_text = json.dumps(synthetic_history(weeks, args.members, args.vote_rate, random.Random(1)),
+                                 ensure_ascii=False, indent=2)
+        # 旧形式は json.loads の結果がそのままメモリ上の形
+        _, old_mem = measure_load(lambda: json.loads(legacy_text))
+
+        # 新形式へは bot.py の移行処理で変換する
+        users = {}
+        messages = {m: bot.decode_vote_entry(e, users) for m, e in json.loads(legacy_text).items()}
+        new_text = bot.dump_json({"version": bot.VOTE_FORMAT_VERSION, "users": users, "messages": messages}, None)
+
+        def load_new():
+            raw = json.loads(new_text)
+            loaded_users = raw["users"]
+            return loaded_users, {m: bot.decode_vote_entry(e, loaded_users) for m, e in raw["messages"].items()}
+        _, new_mem = measure_load(load_new)
+        old_size, new_size = len(legacy_text.encode("utf-8")), len(new_text.encode("utf-8"))
+        print(f"{weeks:>6} {old_mem / 1e6:>9.1f}MB {new_mem / 1e6:>9.1f}MB {old_size / 1e6:>8.2f}MB {new_size / 1e6:>8.2f}MB")
+
+
+# -----------------------------
+# 負荷試験 (Step1 -> 投票 -> Step2 -> Step3)
+# -----------------------------
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def bytes_written():
+    # このプロセスが write 系システムコールで書いたバイト数 (Linux のみ)
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class LoopMonitor:
+    # interval ごとに起きるタスクの遅れ = イベントループが他の処理で止まっていた時間
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self.task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            t0 = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = loop.time() - t0 - self.interval
+            if lag > 0.001:
+                self.max_lag = max(self.max_lag, lag)
+                self.total_lag += lag
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self.task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self.task
+
+
+def fill_history(guild, weeks, vote_rate, rng):
+    # 過去 weeks 週分の投票データ (2 チャンネル x 7 日程) を新形式で入れておく
+    voters = [m for m in guild.members if not m.bot]
+    for m in voters:
+        bot.user_names[str(m.id)] = m.display_name
+    today = bot.today_jst()
+    for w in range(weeks):
+        for level in ("初級", "中級"):
+            ch_id = next(_ids)
+            for d in range(7):
+                date = today - datetime.timedelta(weeks=w + 1, days=d)
+                rec = bot.VoteRecord({str(m.id): rng.randrange(len(bot.STATUSES))
+                                      for m in voters if rng.random() < vote_rate})
+                bot.vote_data[str(next(_ids))] = {"channel": ch_id, "guild": guild.id, f"{date.isoformat()} (曜)": rec}
+    bot.vote_index.rebuild(bot.vote_data)
+    bot.save_votes()
+    bot.flush_all()
+
+
+async def drive_votes(guild, rate, duration, rng, latencies):
+    # rate 件/秒 で投票クリックを到着させる (前のクリックの完了は待たない)
+    loop = asyncio.get_running_loop()
+    messages = [m for ch in guild.text_channels for m in ch.messages if isinstance(m.view, bot.VoteView)]
+    voters = {ch.id: [m for m in ch.members if not m.bot] for ch in guild.text_channels}
+
+    async def click(message, member, arrival):
+        view = message.view
+        await view.handle_vote(FakeInteraction(message, member), rng.randrange(len(bot.STATUSES)))
+        latencies.append(loop.time() - arrival)
+
+    tasks = []
+    start = loop.time()
+    for i in range(max(1, int(rate * duration))):
+        arrival = start + i / rate
+        await asyncio.sleep(max(0.0, arrival - loop.time()))
+        message = rng.choice(messages)
+        tasks.append(loop.create_task(click(message, rng.choice(voters[message.channel.id]), arrival)))
+    await asyncio.gather(*tasks)
+
+
+def bench_load(args):
+    rng = random.Random(1)
+    api = FakeAPI(args.latency)
+    guilds = [FakeGuild(api, f"guild{i}", members=args.members) for i in range(args.guilds)]
+    install_fakes(guilds)
+    reset_state()
+    for g in guilds:
+        FakeGuild.registry.update((ch.id, ch) for ch in g.text_channels)
+        fill_history(g, args.weeks, 0.7, rng)
+
+    # send_confirm_notice は投票ハンドラの中から呼ばれるので、差し替えて個別に時間を測る
+    notice_latencies = []
+    send_confirm_notice = bot.send_confirm_notice
+
+    async def timed_notice(*a, **kw):
+        t0 = time.perf_counter()
+        try:
+            return await send_confirm_notice(*a, **kw)
+        finally:
+            notice_latencies.append(time.perf_counter() - t0)
+    bot.send_confirm_notice = timed_notice
+
+    async def phase(name, run):
+        latencies = []
+        monitor = LoopMonitor()
+        calls_before = api.total()
+        written_before = bytes_written()
+        monitor.start()
+        t0 = time.perf_counter()
+        await run(latencies)
+        elapsed = time.perf_counter() - t0
+        await monitor.stop()
+        bot.flush_all()
+        written = bytes_written()
+        return {
+            "phase": name,
+            "count": len(latencies),
+            "p50": percentile(latencies, 50),
+            "p99": percentile(latencies, 99),
+            "elapsed": elapsed,
+            "max_block": monitor.max_lag,
+            "blocked": monitor.total_lag,
+            "written": None if written is None else written - written_before,
+            "api": api.total() - calls_before,
+        }
+
+    async def timed(step, latencies):
+        t0 = time.perf_counter()
+        await step()
+        latencies.append(time.perf_counter() - t0)
+
+    async def main():
+        rows = [await phase("step1", lambda lat: timed(bot.schedule_step1, lat))]
+        for g in guilds:
+            FakeGuild.registry.update((ch.id, ch) for ch in g.text_channels)
+
+        async def votes(lat):
+            await asyncio.gather(*(drive_votes(g, args.rate / len(guilds), args.duration, rng, lat) for g in guilds))
+        notice_latencies.clear()
+        rows.append(await phase("vote", votes))
+        # 人数確定通知は投票フェーズの内訳 (ループ停止・書き込み・API は投票の行に含まれる)
+        rows.append({"phase": "  notice", "count": len(notice_latencies),
+                     "p50": percentile(notice_latencies, 50), "p99": percentile(notice_latencies, 99)})
+        rows.append(await phase("step2", lambda lat: timed(lambda: bot.schedule_step2(weeks_ahead=None), lat)))
+        rows.append(await phase("step3", lambda lat: timed(lambda: bot.schedule_step3(weeks_ahead=None), lat)))
+        return rows
+
+    # bot.py のログはファイルに書かず捨てる (書き込みバイト数に混ざらないように)
+    with contextlib.redirect_stdout(io.StringIO()):
+        rows = asyncio.run(main())
+
+    print(f"storage={bot.storage.name}  render={bot.VOTE_RENDER_MODE}  guilds={args.guilds}  members={args.members}  "
+          f"weeks={args.weeks}  rate={args.rate}/s x {args.duration}s  latency={args.latency * 1000:.0f}ms")
+    print(f"{'phase':<9} {'count':>6} {'p50':>9} {'p99':>9} {'elapsed':>9} {'max block':>10} {'blocked':>9} {'written':>10} {'api':>6}")
+    for r in rows:
+        def col(key, fmt):
+            if key not in r:
+                return "-"
+            return "n/a" if r[key] is None else fmt(r[key])
+        print(f"{r['phase']:<9} {r['count']:>6} {r['p50'] * 1000:>7.2f}ms {r['p99'] * 1000:>7.2f}ms "
+              f"{col('elapsed', lambda v: f'{v:.3f}s'):>9} {col('max_block', lambda v: f'{v * 1000:.2f}ms'):>10} "
+              f"{col('blocked', lambda v: f'{v * 1000:.1f}ms'):>9} {col('written', lambda v: f'{v / 1024:.1f}KB'):>10} "
+              f"{col('api', str):>6}")
+    print("api calls: " + ", ".join(f"{k}={v}" for k, v in sorted(api.calls.items())))
+
+
+# -----------------------------
+# メッセージごとの直列化 (同時クリック)
+# -----------------------------
+
+def embed_fields(embed):
+    return [(f.name, f.value) for f in embed.fields] if embed else None
+
+
+def bench_actors(args):
+    install_fakes()
+
+    async def run(mode):
+        reset_state()
+        bot.VOTE_RENDER_MODE = mode
+        bot.message_actors = bot.MessageActors()
+        bot.vote_renderer = bot.VoteRenderScheduler(window_ms=args.window)
+        rng = random.Random(1)
+        api = FakeAPI(args.latency, jitter=0.9, rng=rng)
+        guild = FakeGuild(api, members=args.members)
+        await bot.step1_for_guild(guild)
+        messages = [m for m in guild.text_channels[0].messages if isinstance(m.view, bot.VoteView)][:args.messages]
+        voters = [m for m in guild.text_channels[0].members if not m.bot]
+        loop = asyncio.get_running_loop()
+        latencies = []
+
+        async def click(delay, message, member, code):
+            # 到着を args.rate 件/秒に散らす (編集の送信中に次の変更が入るように)
+            await asyncio.sleep(delay)
+            t0 = loop.time()
+            await message.view.handle_vote(FakeInteraction(message, member), code)
+            latencies.append(loop.time() - t0)
+
+        calls_before = api.total()
+        t0 = loop.time()
+        await asyncio.gather(*(click(i / args.rate, rng.choice(messages), rng.choice(voters), rng.randrange(len(bot.STATUSES)))
+                               for i in range(args.clicks)))
+        elapsed = loop.time() - t0
+        # debounce は描画が後から走るので、すべて終わるまで待つ
+        while bot.vote_renderer.pending or bot.message_actors.workers:
+            await asyncio.sleep(0.01)
+        mismatched = 0
+        for m in messages:
+            rec = bot.get_vote_record(str(m.id), m.view.date_str)
+            if embed_fields(m.embed) != embed_fields(bot.build_vote_embed(m.view.date_str, rec)):
+                mismatched += 1
+        return {
+            "throughput": args.clicks / elapsed,
+            "p50": percentile(latencies, 50),
+            "p99": percentile(latencies, 99),
+            "mismatched": mismatched,
+            "api": api.total() - calls_before,
+            "max_backlog": bot.message_actors.max_backlog,
+        }
+
+    print(f"clicks={args.clicks} ({args.rate:.0f}/s)  messages={args.messages}  members={args.members}  "
+          f"latency={args.latency * 1000:.0f}ms ±90%")
+    print(f"{'mode':>9} {'clicks/s':>9} {'p50':>9} {'p99':>9} {'api':>6} {'backlog':>8} {'stale embeds':>13}")
+    failed = False
+    for mode in ("immediate", "debounce"):
+        r = asyncio.run(run(mode))
+        failed |= r["mismatched"] > 0
+        print(f"{mode:>9} {r['throughput']:>9.0f} {r['p50'] * 1000:>7.1f}ms {r['p99'] * 1000:>7.1f}ms "
+              f"{r['api']:>6} {r['max_backlog']:>8} {r['mismatched']:>6}/{args.messages}")
+    if failed:
+        sys.exit("最終の Embed が最終の投票状態と一致しないメッセージがあります")
+
+
+# -----------------------------
+# 画像アップロード待ち
+# -----------------------------
+
+def bench_waiters(args):
+    async def run(waiting, legacy):
+        bot.bot.loop = asyncio.get_running_loop()   # 未ログインでも dispatch がイベントを積めるように
+        api = FakeAPI()
+        guild = FakeGuild(api, members=max(waiting, 1))
+        ch = FakeChannel(guild, "chat")
+        teachers = guild.members[2:2 + waiting]
+        if legacy:
+            # 以前の方式: 1 人ごとに wait_for のリスナーを足す
+            tasks = [asyncio.ensure_future(bot.bot.wait_for(
+                "message", check=lambda m, t=t: m.author == t and m.channel == ch, timeout=300)) for t in teachers]
+        else:
+            tasks = [asyncio.ensure_future(bot.message_waiters.wait(ch.id, t.id)) for t in teachers]
+        await asyncio.sleep(0)
+        # 待っていない人の発言 (= 大多数のメッセージ) を流す
+        chatter = FakeMessage(ch, "hello", author=guild.members[-1] if not waiting else guild.members[1])
+        t0 = time.perf_counter()
+        for i in range(args.messages):
+            bot.bot.dispatch("message", chatter)
+            if i % 10 == 9:
+                await asyncio.sleep(0)   # dispatch が積んだ on_message タスクを流す
+        per_message = (time.perf_counter() - t0) / args.messages
+        # 全員が画像を送ると全員の待ちが解ける
+        for t in teachers:
+            bot.bot.dispatch("message", FakeMessage(ch, "skip", author=t))
+        done = await asyncio.gather(*tasks, return_exceptions=True)
+        assert all(isinstance(m, FakeMessage) for m in done), done[:3]
+        return per_message
+
+    print(f"messages={args.messages}  (待っていない人のメッセージ 1 件を bot.dispatch する時間)")
+    print(f"{'waiting':>8} {'wait_for':>12} {'registry':>12}")
+    asyncio.run(run(0, False))   # ウォームアップ
+    for n in args.waiting:
+        legacy = asyncio.run(run(n, True))
+        registry = asyncio.run(run(n, False))
+        print(f"{n:>8} {fmt_us(legacy):>12} {fmt_us(registry):>12}")
+
+    async def timeouts():
+        # タイムアウトはタイマーホイールの 1 本のタスクでまとめて処理される
+        bot.message_waiters = bot.WaiterRegistry()
+        bot.message_waiters.wheel = bot.TimerWheel(tick=0.01)
+        results = await asyncio.gather(*(bot.message_waiters.wait(1, uid, timeout=0.05 + uid * 0.01) for uid in range(20)),
+                                       return_exceptions=True)
+        return sum(isinstance(r, asyncio.TimeoutError) for r in results), bot.message_waiters.stats()
+    expired, stats = asyncio.run(timeouts())
+    print(f"timeouts: {expired}/20 件がタイムアウト  stats={stats}")
+
+
+# -----------------------------
+# Step1 (級の並行化・再実行・途中再開)
+# -----------------------------
+
+def duplicate_posts(guild):
+    dup = 0
+    for ch in guild.text_channels:
+        titles = [m.embed.title for m in ch.messages if m.embed]
+        dup += len(titles) - len(set(titles))
+    return dup
+
+
+def bench_step1(args):
+    install_fakes()
+
+    async def run():
+        rows = []
+
+        async def measure(label, guild, coro):
+            before = dict(guild.api.calls)
+            t0 = time.perf_counter()
+            try:
+                await coro
+                error = ""
+            except Exception as e:
+                error = str(e)
+            elapsed = time.perf_counter() - t0
+            calls = {k: v - before.get(k, 0) for k, v in guild.api.calls.items() if v - before.get(k, 0)}
+            rows.append((label, elapsed, sum(calls.values()), calls, duplicate_posts(guild), error))
+
+        async def sequential(guild):
+            # 以前の方式の比較用: 級を 1 つずつ処理する
+            start = bot.get_schedule_start(weeks_ahead=3)
+            for level in bot.LEVELS:
+                await bot.step1_for_level(guild, level, bot.get_week_name(start), bot.generate_week_schedule(start))
+
+        reset_state()
+        guild = FakeGuild(FakeAPI(args.latency), members=args.members)
+        await measure("sequential", guild, sequential(guild))
+
+        reset_state()
+        guild = FakeGuild(FakeAPI(args.latency), members=args.members)
+        await measure("parallel", guild, bot.step1_for_guild(guild))
+        await measure("rerun", guild, bot.step1_for_guild(guild))
+
+        # 途中で送信が失敗 -> 再実行で続きから
+        reset_state()
+        guild = FakeGuild(FakeAPI(args.latency), members=args.members)
+        real_create = guild.create_text_channel
+
+        async def flaky_create(*a, **kw):
+            ch = await real_create(*a, **kw)
+            ch.fail_after = args.fail_after
+            return ch
+        guild.create_text_channel = flaky_create
+        await measure("crash", guild, bot.step1_for_guild(guild))
+        for ch in guild.text_channels:
+            ch.fail_after = None
+        await measure("resume", guild, bot.step1_for_guild(guild))
+
+        # 投稿後・記録前に止まった分 (vote_data から消す) -> 履歴から拾って投稿しない
+        lost = [m for m in guild.text_channels[0].messages[-2:]]
+        for m in lost:
+            bot.vote_index.remove(str(m.id), bot.vote_data.pop(str(m.id)))
+        await measure("unrecorded", guild, bot.step1_for_guild(guild))
+        return rows
+
+    print(f"levels={len(bot.LEVELS)} x 7 dates  latency={args.latency * 1000:.0f}ms  fail_after={args.fail_after}")
+    print(f"{'run':<11} {'elapsed':>8} {'api':>5} {'dups':>5}  calls")
+    for label, elapsed, total, calls, dups, error in asyncio.run(run()):
+        detail = ", ".join(f"{k}={v}" for k, v in sorted(calls.items()))
+        print(f"{label:<11} {elapsed:>7.3f}s {total:>5} {dups:>5}  {detail}" + (f"  (error: {error})" if error else ""))
+
+
+# -----------------------------
+# 出欠集計 (/stats)
+# -----------------------------
+
+def rollup_history(weeks, members, vote_rate, rng):
+    # 新形式の vote_data と confirmed: 週ごとに級 x 7 日程、各メンバーは vote_rate の確率で投票する
+    uids = [str(10 ** 17 + i) for i in range(members)]
+    data, done = {}, {}
+    msg_ids = itertools.count(10 ** 18)
+    start = datetime.date(2025, 1, 5)
+    for w in range(weeks):
+        for level in bot.LEVELS:
+            ch_id = next(_ids)   # Step1 と同じく 週 x 級 ごとに 1 チャンネル
+            for d in range(7):
+                date = start + datetime.timedelta(weeks=w, days=d)
+                date_str = f"{date.isoformat()} (曜)"
+                rec = bot.VoteRecord({uid: rng.randrange(3) for uid in uids if rng.random() < vote_rate})
+                msg_id = str(next(msg_ids))
+                data[msg_id] = {"channel": ch_id, "guild": 1, "level": level, date_str: rec}
+                if rec.counts[bot.YES]:
+                    done[f"{msg_id}|{date_str}"] = {"level": level, "final": rng.choice(bot.OUTCOMES)}
+    return data, done
+
+
+def naive_stats(user_id, recent):
+    # 集計なしの場合: 全履歴を走査して直近の週だけ数える
+    user, levels = {}, {}
+    for entry in bot.vote_data.values():
+        level = entry.get("level") if entry.get("level") in bot.LEVELS else bot.UNKNOWN_LEVEL
+        for date_str in bot.entry_dates(entry):
+            d = bot.parse_vote_date(date_str)
+            if d is None or bot.archive_week_key(d) not in recent:
+                continue
+            day = bot.WEEKDAY_JP[d.weekday()]
+            for uid, code in entry[date_str].users.items():
+                levels.setdefault(level, {}).setdefault(day, [0, 0, 0])[code] += 1
+                if uid == user_id:
+                    user.setdefault(level, {}).setdefault(day, [0, 0, 0])[code] += 1
+    return user, levels
+
+
+def bench_rollups(args):
+    print(f"members={args.members}  vote_rate={args.vote_rate}  /stats の対象 = 直近 {args.recent} 週")
+    print(f"{'weeks':>6} {'rebuild':>9} {'scan':>10} {'rollup':>10} {'same':>5}")
+    for weeks in args.weeks:
+        reset_state()
+        data, done = rollup_history(weeks, args.members, args.vote_rate, random.Random(1))
+        bot.vote_data.update(data)
+        bot.confirmed.update(done)
+        uid = str(10 ** 17)
+
+        t0 = time.perf_counter()
+        bot.rebuild_live_rollups()
+        rebuild = time.perf_counter() - t0
+
+        # 今日 = 合成した履歴の最終日
+        today = datetime.date(2025, 1, 5) + datetime.timedelta(weeks=weeks, days=-1)
+        recent_weeks = bot.attendance.recent_weeks(args.recent, today)
+        recent = set(recent_weeks)
+        t0 = time.perf_counter()
+        for _ in range(args.queries):
+            scanned = naive_stats(uid, recent)
+        scan = (time.perf_counter() - t0) / args.queries
+
+        t0 = time.perf_counter()
+        for _ in range(args.queries):
+            week_keys = bot.attendance.recent_weeks(args.recent, today)
+            rolled = (bot.attendance.user_summary(uid, week_keys), bot.attendance.level_summary(week_keys)[0])
+        rollup = (time.perf_counter() - t0) / args.queries
+        print(f"{weeks:>6} {rebuild * 1000:>7.0f}ms {fmt_us(scan):>10} {fmt_us(rollup):>10} {'yes' if rolled == scanned else 'NO':>5}")
+
+
+# -----------------------------
+# 投票メッセージの索引
+# -----------------------------
+
+def scan_channel_dates(guild_id, today):
+    # 索引なしの場合 (以前の storage.channel_dates + is_active_date): 全メッセージを走査して並べる
+    rows = [(data.get("channel"), msg_id, d)
+            for msg_id, data in bot.vote_data.items()
+            if data.get("guild") in (guild_id, None)
+            for d in bot.entry_dates(data)]
+    rows.sort(key=lambda r: (r[0] or 0, r[2]))
+    return [r for r in rows if bot.is_active_date(r[2], today)]
+
+
+def scan_expired(cutoff):
+    return {m for m, e in bot.vote_data.items() if (bot.entry_last_date(e) or cutoff) < cutoff}
+
+
+def index_expired(cutoff):
+    return {m for m in bot.vote_index.messages_until(bot.archive_week_key(cutoff))
+            if (bot.entry_last_date(bot.vote_data[m]) or cutoff) < cutoff}
+
+
+def bench_index(args):
+    # 今日 = 最後の週の途中 (Step2/3 は今日以降の日程が対象)。
+    # 保持期間は毎日のジョブで古い週から順に外れていく定常状態として、最古の週の途中を cutoff にする
+    print(f"members={args.members}  1 週 = {len(bot.LEVELS)} 級 x 7 日程")
+    print(f"{'weeks':>6} {'build':>8} {'query':<13} {'scan':>11} {'index':>11} {'same':>5}")
+    bot.RETENTION_DAYS = 0
+    for weeks in args.weeks:
+        reset_state()
+        data, _ = rollup_history(weeks, args.members, 0.5, random.Random(1))
+        bot.vote_data.update(data)
+        t0 = time.perf_counter()
+        bot.vote_index.rebuild(bot.vote_data)
+        build = time.perf_counter() - t0
+
+        today = datetime.date(2025, 1, 5) + datetime.timedelta(weeks=weeks - 1, days=3)
+        cutoff = datetime.date(2025, 1, 5) + datetime.timedelta(days=3)
+        last_channel = bot.vote_data[max(bot.vote_data)]["channel"]
+        queries = [
+            ("step2/3", lambda: scan_channel_dates(1, today), lambda: bot.active_channel_dates(1, today)),
+            ("step1", lambda: {d for e in bot.vote_data.values() if e.get("channel") == last_channel for d in bot.entry_dates(e)},
+                      lambda: {d for m in bot.vote_index.channel_messages(last_channel) for d in bot.entry_dates(bot.vote_data[m])}),
+            ("retention", lambda: scan_expired(cutoff), lambda: index_expired(cutoff)),
+        ]
+        for i, (label, scan, indexed) in enumerate(queries):
+            t0 = time.perf_counter()
+            for _ in range(args.queries):
+                expected = scan()
+            scan_t = (time.perf_counter() - t0) / args.queries
+            t0 = time.perf_counter()
+            for _ in range(args.queries):
+                got = indexed()
+            index_t = (time.perf_counter() - t0) / args.queries
+            head = f"{weeks:>6} {build * 1000:>6.1f}ms" if i == 0 else " " * 15
+            print(f"{head} {label:<13} {fmt_us(scan_t):>11} {fmt_us(index_t):>11} {'yes' if got == expected else 'NO':>5}")
+
+
+# -----------------------------
+# 操作トレースの再生
+# TRACE_FILE で記録したトレース (または --synthetic で作った日曜朝の山) を、
+# フェイクの Discord オブジェクト上で実際のハンドラに 1 件ずつ、記録時の間隔 / speed で流す。
+# -----------------------------
+TRACE_STAFF_KINDS = ("confirm", "cancel", "studio", "upload")
+
+
+def synthetic_trace(path, members, rng):
+    # Step1 の投稿直後に投票が集中し、押し直しがあり、その途中で講師が開催可否を決める流れ
+    rec = bot.TraceRecorder(path, "bench")
+    t0 = 1_760_000_000.0
+    week = bot.generate_week_schedule(datetime.datetime(2025, 12, 7))
+    channels = {level: next(_ids) for level in bot.LEVELS}
+    messages = {(level, d): next(_ids) for level in bot.LEVELS for d in week}
+    notice_ch, teacher, admin = next(_ids), next(_ids), next(_ids)
+
+    def vote(t, uid, level, date_str, status):
+        rec.record("vote", t=t, user=rec.anon(uid), channel=rec.anon(channels[level]),
+                   message=rec.anon(messages[level, date_str]), date=date_str, level=level, status=status)
+
+    rec.record("command", t=t0 + 1, name="place", options={"action": "一覧"},
+               user=rec.anon(admin), channel=rec.anon(notice_ch))
+    for i in range(members):
+        uid, level = next(_ids), bot.LEVELS[i % len(bot.LEVELS)]
+        t = t0 + rng.expovariate(1 / 90)   # 大半は投稿から数分以内
+        for date_str in rng.sample(week, rng.randint(3, 7)):
+            status = rng.randrange(3)
+            vote(t, uid, level, date_str, status)
+            t += rng.uniform(0.3, 2.0)
+            if rng.random() < 0.25:
+                # 押し直し: 同じボタンで取り消してから別のボタン
+                vote(t, uid, level, date_str, status)
+                t += rng.uniform(0.3, 1.5)
+                vote(t, uid, level, date_str, (status + 1) % 3)
+                t += rng.uniform(0.3, 1.5)
+    for n, date_str in enumerate(rng.sample(week, 6)):
+        level = bot.LEVELS[n % len(bot.LEVELS)]
+        notice = {"message": rec.anon(messages[level, date_str]), "date": date_str, "level": level,
+                  "user": rec.anon(teacher), "channel": rec.anon(notice_ch)}
+        t = t0 + rng.uniform(60, 300)
+        if n % 3 == 2:
+            rec.record("cancel", t=t, **notice)
+            continue
+        rec.record("confirm", t=t, **notice)
+        rec.record("studio", t=t + rng.uniform(3, 8), studio="スタジオA", **notice)
+        rec.record("upload", t=t + rng.uniform(10, 20), user=notice["user"], channel=notice["channel"],
+                   skip=True, attachment=False)
+    rec.record("command", t=t0 + 240, name="run_step", options={"step": 2},
+               user=rec.anon(admin), channel=rec.anon(notice_ch))
+    rec.fp.close()
+    return rec.events
+
+
+def load_trace(path):
+    with open(path, encoding="utf-8") as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    events.sort(key=lambda e: e["t"])
+    return events
+
+
+async def replay_trace(events, speed, latency):
+    reset_state()
+    api = FakeAPI(latency)
+    guild = FakeGuild(api, members=0)
+    install_fakes([guild])
+    role = {r.name: r for r in guild.roles}
+    bot.locations[str(guild.id)] = sorted({e["studio"] for e in events if e.get("studio")}) or ["replay"]
+
+    members, channels, messages = {}, {}, {}
+
+    def member(anon, kind):
+        if anon not in members:
+            members[anon] = FakeMember(guild, f"user-{anon}")
+            guild.members.append(members[anon])
+        m = members[anon]
+        extra = role["講師"] if kind in TRACE_STAFF_KINDS else role["管理者"] if kind == "command" else None
+        if extra is not None and extra not in m.roles:
+            m.roles.append(extra)
+        return m
+
+    def channel(anon, level=None):
+        if anon not in channels:
+            ch = FakeChannel(guild, f"replay-{level or 'other'}-{anon}")
+            guild.text_channels.append(ch)
+            FakeGuild.registry[ch.id] = ch
+            channels[anon] = ch
+        return channels[anon]
+
+    def vote_message(anon, date_str, level, ch=None):
+        # Step1 で投稿済みだった投票メッセージを先に用意しておく
+        if anon not in messages:
+            ch = ch or channel(f"{level}-votes", level)
+            msg = FakeMessage(ch, embed=None, view=bot.VoteView(date_str), author=BOT_USER)
+            ch.messages.append(msg)
+            bot.vote_data[str(msg.id)] = {"channel": ch.id, "guild": guild.id, "level": level, date_str: bot.VoteRecord()}
+            bot.record_vote_message(str(msg.id), ch.id, date_str, guild.id, level)
+            messages[anon] = msg
+        return messages[anon]
+
+    for e in events:
+        member(e.get("user"), e["kind"])
+        for anon in e.get("ids", {}).values():
+            member(anon, None)
+        if e["kind"] == "vote":
+            vote_message(e["message"], e["date"], e.get("level"), channel(e["channel"], e.get("level")))
+    for e in events:
+        if e["kind"] in ("confirm", "cancel", "studio"):
+            vote_message(e["message"], e["date"], e.get("level") or bot.UNKNOWN_LEVEL)
+
+    async def handle(e):
+        kind, user = e["kind"], members[e.get("user")]
+        if kind == "vote":
+            msg = messages[e["message"]]
+            await msg.view.handle_vote(FakeInteraction(msg, user), e["status"])
+            return
+        if kind == "upload":
+            msg = FakeMessage(channel(e["channel"]), content="skip" if e.get("skip") else "", author=user)
+            await bot._waiters_on_message(msg)
+            return
+        ix = FakeInteraction(None, user, channel=channel(e["channel"]))
+        if kind == "command":
+            # ids (メンバー指定など) はトレース内の同じ匿名 ID のメンバーに置き換える
+            options = {**e.get("options", {}), **{k: member(v, None) for k, v in e.get("ids", {}).items()}}
+            await bot.tree.get_command(e["name"]).callback(ix, **options)
+            return
+        key = f"{messages[e['message']].id}|{e['date']}"
+        level = e.get("level") or bot.UNKNOWN_LEVEL
+        if kind in ("confirm", "cancel"):
+            view = bot.ConfirmViewWithImage(level, e["date"], notice_key=key)
+            await (view.confirm_button if kind == "confirm" else view.cancel_button).callback(ix)
+        elif kind == "studio":
+            dropdown = bot.StudioDropdown(e["date"], [discord.SelectOption(label=e["studio"])], key)
+            dropdown._values = [e["studio"]]
+            await dropdown.callback(ix)
+
+    loop = asyncio.get_running_loop()
+    latencies, errors = {}, {}
+
+    async def run(e, arrival):
+        try:
+            await handle(e)
+        except Exception:
+            errors[e["kind"]] = errors.get(e["kind"], 0) + 1
+        latencies.setdefault(e["kind"], []).append(loop.time() - arrival)
+
+    monitor = LoopMonitor()
+    monitor.start()
+    start = loop.time()
+    t0 = events[0]["t"]
+    pending = set()
+    for e in events:
+        arrival = start + (e["t"] - t0) / speed
+        await asyncio.sleep(max(0.0, arrival - loop.time()))
+        pending.add(loop.create_task(run(e, arrival)))
+    # 全件流した後も画像を待っているスタジオ選択は、もう返信が来ないので取り消す
+    while pending:
+        for key in list(bot.message_waiters.waiters):
+            bot.message_waiters.cancel(*key)
+        _, pending = await asyncio.wait(pending, timeout=0.05)
+    elapsed = loop.time() - start
+    await monitor.stop()
+    return latencies, errors, elapsed, monitor.max_lag, api
+
+
+def bench_replay(args):
+    if args.synthetic or not args.trace:
+        path = args.trace or os.path.join(os.getcwd(), "synthetic-trace.ndjson")
+        count = synthetic_trace(path, args.members, random.Random(1))
+        print(f"synthetic trace: {count} events -> {path}")
+    else:
+        path = args.trace
+    events = load_trace(path)
+    if not events:
+        print("トレースが空です。")
+        return
+    install_fakes()
+    # 記録した日の日付で再生する (過ぎた日程への投票は締め切り扱いになるので)
+    recorded_on = datetime.datetime.fromtimestamp(events[0]["t"], bot.JST).date()
+    bot.today_jst = lambda: recorded_on
+    span = events[-1]["t"] - events[0]["t"]
+    kinds = sorted({e["kind"] for e in events}, key=[e["kind"] for e in events].index)
+    print(f"{len(events)} events over {span:.0f}s  latency={args.latency * 1000:.0f}ms  "
+          f"(studio はスタジオ選択から画像の返信までを含む)")
+    print(f"{'speed':>6} {'kind':<8} {'count':>6} {'p50':>9} {'p99':>9} {'max':>9} {'errors':>6}   {'events/s':>8} {'max block':>10} {'api':>6}")
+    for speed in args.speed:
+        with contextlib.redirect_stdout(io.StringIO()):
+            latencies, errors, elapsed, max_lag, api = asyncio.run(replay_trace(events, speed, args.latency))
+        for i, kind in enumerate(kinds):
+            lat = latencies.get(kind, [])
+            tail = (f"   {len(events) / elapsed:>8.1f} {max_lag * 1000:>8.2f}ms {api.total():>6}" if i == 0 else "")
+            print(f"{str(speed) + 'x' if i == 0 else '':>6} {kind:<8} {len(lat):>6} {percentile(lat, 50) * 1000:>7.2f}ms "
+                  f"{percentile(lat, 99) * 1000:>7.2f}ms {max(lat, default=0) * 1000:>7.2f}ms {errors.get(kind, 0):>6}" + tail)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bot.py のオフラインベンチマーク")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("vote", help="1 投票あたりのトグルコスト")
+    p.add_argument("--voters", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    p.add_argument("--iterations", type=int, default=20000)
+    p.set_defaults(func=bench_vote)
+    p = sub.add_parser("guilds", help="サーバー数ごとの Step1~3 所要時間")
+    p.add_argument("--guilds", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    p.add_argument("--members", type=int, default=50)
+    p.add_argument("--latency", type=float, default=0.01, help="フェイク API 1 回あたりの遅延 (秒)")
+    p.set_defaults(func=bench_guilds)
+    p = sub.add_parser("reminders", help="Step3 のリマインド送信数")
+    p.add_argument("--members", type=int, default=60)
+    p.add_argument("--vote-rate", type=float, default=0.5)
+    p.set_defaults(func=bench_reminders)
+    p = sub.add_parser("status", help="Step2 の投票状況通知の送信数")
+    p.add_argument("--members", type=int, default=60)
+    p.set_defaults(func=bench_status)
+    p = sub.add_parser("compact", help="投票データのメモリ量と votes.json のサイズ")
+    p.add_argument("--weeks", type=int, nargs="+", default=[4, 26, 52])
+    p.add_argument("--members", type=int, default=60)
+    p.add_argument("--vote-rate", type=float, default=0.7)
+    p.set_defaults(func=bench_compact)
+    p = sub.add_parser("load", help="Step1~3 と投票ハンドラの負荷試験")
+    p.add_argument("--guilds", type=int, default=1)
+    p.add_argument("--members", type=int, default=60)
+    p.add_argument("--weeks", type=int, default=26, help="事前に入れておく過去の投票データの週数")
+    p.add_argument("--rate", type=float, default=50, help="1 秒あたりの投票クリック数 (全サーバー合計)")
+    p.add_argument("--duration", type=float, default=5, help="投票を流す秒数")
+    p.add_argument("--latency", type=float, default=0.02, help="フェイク API 1 回あたりの遅延 (秒)")
+    p.set_defaults(func=bench_load)
+    p = sub.add_parser("actors", help="同じメッセージへの同時クリックの直列化")
+    p.add_argument("--clicks", type=int, default=500)
+    p.add_argument("--rate", type=float, default=1000, help="クリックの到着レート (件/秒)")
+    p.add_argument("--messages", type=int, default=3)
+    p.add_argument("--members", type=int, default=60)
+    p.add_argument("--latency", type=float, default=0.02)
+    p.add_argument("--window", type=int, default=100, help="debounce の描画間隔 (ms)")
+    p.set_defaults(func=bench_actors)
+    p = sub.add_parser("waiters", help="画像待ちの人数ごとのメッセージ処理コスト")
+    p.add_argument("--waiting", type=int, nargs="+", default=[0, 10, 100, 1000])
+    p.add_argument("--messages", type=int, default=5000)
+    p.set_defaults(func=bench_waiters)
+    p = sub.add_parser("step1", help="Step1 の所要時間と API 呼び出し数")
+    p.add_argument("--members", type=int, default=60)
+    p.add_argument("--latency", type=float, default=0.05)
+    p.add_argument("--fail-after", type=int, default=3, help="途中再開の試験で各チャンネルが何件送った後に失敗するか")
+    p.set_defaults(func=bench_step1)
+    p = sub.add_parser("rollups", help="/stats の集計: 全履歴の走査と差分集計の比較")
+    p.add_argument("--weeks", type=int, nargs="+", default=[4, 26, 52, 104])
+    p.add_argument("--members", type=int, default=60)
+    p.add_argument("--vote-rate", type=float, default=0.7)
+    p.add_argument("--recent", type=int, default=8)
+    p.add_argument("--queries", type=int, default=20)
+    p.set_defaults(func=bench_rollups)
+    p = sub.add_parser("index", help="索引あり/なしでの Step1~3・保持期間の対象メッセージの取り出し")
+    p.add_argument("--weeks", type=int, nargs="+", default=[4, 26, 52, 104])
+    p.add_argument("--members", type=int, default=20)
+    p.add_argument("--queries", type=int, default=50)
+    p.set_defaults(func=bench_index)
+    p = sub.add_parser("replay", help="記録した操作トレースを 1x~100x で再生")
+    p.add_argument("trace", nargs="?", help="TRACE_FILE で記録した NDJSON (省略時は合成したトレース)")
+    p.add_argument("--synthetic", action="store_true", help="日曜朝の山を合成して trace (省略時は一時ファイル) に書いてから再生")
+    p.add_argument("--members", type=int, default=60, help="合成するトレースのメンバー数")
+    p.add_argument("--speed", type=float, nargs="+", default=[10, 100], help="再生速度 (1 = 記録時と同じ間隔)")
+    p.add_argument("--latency", type=float, default=0.02)
+    p.set_defaults(func=bench_replay)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,24 +5,50 @@ from discord import app_commands
 from discord.ext import commands
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
-from apscheduler.triggers.date import DateTrigger
+from apscheduler.jobstores.base import BaseJobStore, ConflictingIdError, JobLookupError
+from apscheduler.job import Job
+from apscheduler.util import datetime_to_utc_timestamp, utc_timestamp_to_datetime, obj_to_ref
+from aiohttp import web
 import datetime
 import pytz
 import json
+import gzip
+import hashlib
+import sys
+import sqlite3
 import asyncio
+import atexit
+import time
+import heapq
+import itertools
+import bisect
+import functools
+import collections
+import math
+import array
+import pickle
+import threading
+import cProfile
+import pstats
+import abc
+import selectors
 
 # -----------------------------
 # 設定
 # -----------------------------
 TOKEN = os.getenv("DISCORD_BOT_TOKEN")
-if not TOKEN:
-    raise RuntimeError("環境変数 DISCORD_BOT_TOKEN を設定してください。")
 
 JST = pytz.timezone("Asia/Tokyo")
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
-bot = commands.Bot(command_prefix="!", intents=intents)
+# 複数サーバーで動かす場合は BOT_SHARDED=1 (SHARD_COUNT 未指定なら Discord 推奨のシャード数)
+BOT_SHARDED = os.getenv("BOT_SHARDED", "0") == "1"
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0")) or None
+if BOT_SHARDED:
+    bot = commands.AutoShardedBot(command_prefix="!", intents=intents, shard_count=SHARD_COUNT)
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents)
 tree = bot.tree
 
 DATA_DIR = "./data"
@@ -32,9 +58,9 @@ LOC_FILE = os.path.join(DATA_DIR, "locations.json")
 CONFIRMED_FILE = os.path.join(DATA_DIR, "confirmed.json")
 
 # データ
-vote_data = {}      # message_id -> {"channel": id, "YYYY-MM-DD (曜)": {statuses...}}
-locations = {}      # {"共通": [name,...]}
-confirmed = {}      # key -> info
+vote_data = {}      # message_id -> {"channel": id, "guild": id, "YYYY-MM-DD (曜)": {statuses...}}
+locations = {}      # {"<guild_id>": [name,...], "共通": [name,...] (旧形式: 全サーバー共通)}
+confirmed = {}      # key -> info (info["guild"] に送信元サーバー)
 
 # -----------------------------
 # ヘルパー: JSON読み書き
@@ -51,46 +77,1215 @@ def load_json(path, default):
         return default
 
 
-def save_json(path, obj):
+def write_json_atomic(path, text):
+    # 一時ファイルに書いてから rename するので、書き込み途中で落ちても元ファイルは壊れない
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def file_signature(path):
+    # 外部から書き換えられたかの判定用 (無ければ None)
     try:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(obj, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"⚠ save_json error {path}: {e}")
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+class StateCache:
+    # ファイル (や DB) から読んだ状態を署名つきで持ち、署名が変わった時だけ読み直す。
+    # 返すのはキャッシュしているオブジェクトそのもの (呼び出し側で変更して保存する前提)
+    def __init__(self):
+        self.entries = {}   # key -> (署名, 値)
+
+    def get(self, key, signature, load, pinned=False):
+        # pinned: 未保存の変更があるので署名に関係なくメモリ上の値を使う
+        entry = self.entries.get(key)
+        name = os.path.basename(key)
+        if entry is not None and (pinned or entry[0] == signature):
+            metrics.inc("state_cache_hits", file=name)
+            return entry[1]
+        metrics.inc("state_cache_misses", file=name)
+        value = load()
+        self.entries[key] = (signature, value)
+        return value
+
+    def refresh(self, key, signature, value):
+        # 自分で書き込んだ後は署名だけ更新する (次の読み込みで読み直さない)
+        if key in self.entries:
+            self.entries[key] = (signature, value)
+
+
+state_cache = StateCache()
+
+
+def json_default(obj):
+    # VoteRecord は {user_id: ステータスコード} として書き出す
+    if isinstance(obj, VoteRecord):
+        return obj.users
+    # 集計の配列はそのままリストで
+    if isinstance(obj, array.array):
+        return obj.tolist()
+    raise TypeError(f"{type(obj).__name__} は JSON にできません")
+
+
+def dump_json(obj, indent=2):
+    separators = (",", ":") if indent is None else None
+    return json.dumps(obj, ensure_ascii=False, indent=indent, separators=separators, default=json_default)
+
+# -----------------------------
+# メトリクス
+# ハンドラ・定期ジョブ・ファイル書き込み・Discord API 呼び出しの回数とレイテンシを集計する。
+# METRICS_PORT を指定すると http://METRICS_HOST:METRICS_PORT/metrics で Prometheus 形式を返す。
+# 管理者は /metrics で要約を見られる。
+# -----------------------------
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))       # 0 なら HTTP は無効
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PREFIX = "darbuka_"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)   # 最後は +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # 該当するバケットの上限で近似する (+Inf に入った場合は最大のバケット)
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return LATENCY_BUCKETS[-1]
+
+
+class Metrics:
+    def __init__(self):
+        self.counters = {}     # (name, labels) -> 値
+        self.histograms = {}   # (name, labels) -> Histogram
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = Histogram()
+        hist.observe(seconds)
+
+    def render(self):
+        # Prometheus のテキスト形式
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(self.counters.items()):
+            full = f"{METRICS_PREFIX}{name}_total"
+            declare(full, "counter")
+            lines.append(f"{full}{format_labels(labels)} {value}")
+        for (name, labels), hist in sorted(self.histograms.items()):
+            full = f"{METRICS_PREFIX}{name}"
+            declare(full, "histogram")
+            cumulative = 0
+            for bound, n in zip(LATENCY_BUCKETS + ("+Inf",), hist.counts):
+                cumulative += n
+                lines.append(f"{full}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{full}_sum{format_labels(labels)} {hist.sum}")
+            lines.append(f"{full}_count{format_labels(labels)} {hist.count}")
+        for name, labels, value in collect_gauges():
+            full = f"{METRICS_PREFIX}{name}"
+            declare(full, "gauge")
+            lines.append(f"{full}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+metrics = Metrics()
+
+
+def instrumented(name, kind="handler", label="handler"):
+    # async 関数の所要時間を {kind}_seconds{label=name} に、例外を {kind}_errors_total に記録する。
+    # ラベル名は kind と別に指定する ("job" は Prometheus がスクレイプ先に使う予約ラベルなので使わない)
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            token = profiler.enter(f"{kind}:{name}")
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                metrics.inc(f"{kind}_errors", **{label: name})
+                raise
+            finally:
+                if token is not None:
+                    profiler.exit(token)
+                metrics.observe(f"{kind}_seconds", time.perf_counter() - t0, **{label: name})
+        return wrapper
+    return decorator
+
+
+def collect_gauges():
+    # 各コンポーネントがすでに持っている統計をその場で読む
+    gauges = [
+        ("vote_messages", (), len(vote_data)),
+        ("confirmed_entries", (), len(confirmed)),
+        ("known_users", (), len(user_names)),
+        ("outbound_queue_depth", (), outbound.depth),
+        ("outbound_queue_max_depth", (), outbound.max_depth),
+        ("vote_render_pending", (), len(vote_renderer.pending)),
+        ("message_actors_active", (), len(message_actors.workers)),
+        ("message_waiters_active", (), len(message_waiters.waiters)),
+        ("message_waiters_timed_out", (), message_waiters.timed_out),
+        ("eligible_cache_channels", (), len(eligible_voters.channels)),
+    ]
+    for file, st in persist_stats().items():
+        for key in ("pending", "writes"):
+            if key in st:
+                gauges.append((f"persist_{key}", (("file", file),), st[key]))
+    return gauges
+
+
+metrics_runner = None
+
+
+async def start_metrics_server():
+    global metrics_runner
+    if not METRICS_PORT or metrics_runner is not None:
+        return
+
+    async def handle(request):
+        return web.Response(body=metrics.render().encode("utf-8"),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    metrics_runner = runner
+    print(f"✅ メトリクス: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+# -----------------------------
+# プロファイル
+# 管理者が /profile で (または起動時に PROFILE_NEXT で) 「次の N 回」を計測対象にする。
+# 対象: instrumented の付いたハンドラ・定期ジョブ (vote, confirm_notice, step1~3 など) と
+# JSON の書き込み (persist)。PROFILE_TARGETS / /profile の targets はカンマ区切りで、
+# 名前 (step2) でも種類 (job, handler, persist) でも指定できる。空なら全部。
+# 計測中のスレッドごとに cProfile を有効にし、別スレッドでスタックを PROFILE_SAMPLE_MS ごとに採る。
+# cProfile は await 中も有効なままなので、イベントループ自体 (asyncio / selectors) の関数は
+# 要約とスタックから除き、select で待っているだけのサンプルは「待機」として別に数える。
+# N 回終わると data/profiles/<日時>-<対象>.pstats と .collapsed (flamegraph.pl 形式) を
+# 別スレッドで書き出す (.pstats にはループの関数も含めてすべて残す)。
+# -----------------------------
+PROFILE_DIR = os.path.join(DATA_DIR, "profiles")
+PROFILE_NEXT = int(os.getenv("PROFILE_NEXT", "0"))
+PROFILE_TARGETS = os.getenv("PROFILE_TARGETS", "")
+PROFILE_SAMPLE_MS = int(os.getenv("PROFILE_SAMPLE_MS", "5"))
+PROFILE_TOP = 15
+
+
+def parse_profile_targets(text):
+    return tuple(t.strip() for t in (text or "").split(",") if t.strip())
+
+
+LOOP_SOURCES = (os.path.dirname(asyncio.__file__) + os.sep, selectors.__file__)
+# cProfile が記録する組み込み関数のうちループの待機・コールバック呼び出しにあたるもの
+LOOP_BUILTINS = ("of 'select.", "of '_contextvars.Context'")
+
+
+def is_loop_frame(filename, name=""):
+    if filename == "~":
+        return any(b in name for b in LOOP_BUILTINS)
+    return filename.startswith(LOOP_SOURCES)
+
+
+def collapse_stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        if not is_loop_frame(code.co_filename):
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Profiler:
+    def __init__(self, sample_ms=PROFILE_SAMPLE_MS):
+        self.lock = threading.Lock()
+        self.sample_interval = sample_ms / 1000
+        self.remaining = 0         # あと何回計測するか
+        self.targets = ()
+        self.profiles = {}         # thread ident -> cProfile.Profile (そのスレッドでだけ enable する)
+        self.depth = {}            # thread ident -> 計測中の呼び出しの入れ子数
+        self.samples = collections.Counter()   # 折りたたんだスタック -> サンプル数
+        self.idle = 0              # ループが select で待っていた (または自身の処理中だった) サンプル数
+        self.calls = collections.Counter()     # 計測した呼び出し (kind:name) -> 回数
+        self.sampler = None
+        self.stop_sampling = None
+        self.waiters = []          # 終了を待つ (loop, future)
+        self.last = None           # 直近の結果 (ファイルのパス, 要約)
+        self.finishing = None      # 書き出し中の task (GC されないように参照を持つ)
+
+    def arm(self, count, targets=()):
+        # 止める時 (0) に書き出しを始めたら、その結果 (パス, 要約) を待てる task を返す
+        with self.lock:
+            self.remaining = max(count, 0)
+            if count:
+                # 止める時 (0) は書き出すファイル名に今回の対象を残す
+                self.targets = tuple(targets)
+        if not count:
+            return self._finish_if_done()
+        return None
+
+    def matches(self, label):
+        kind, _, name = label.partition(":")
+        return not self.targets or any(t in (label, kind, name) for t in self.targets)
+
+    def enter(self, label):
+        # 計測対象なら token (スレッド ident) を返す。対象外なら None
+        if self.remaining <= 0:
+            return None
+        ident = threading.get_ident()
+        with self.lock:
+            if self.remaining <= 0 or not self.matches(label):
+                return None
+            self.remaining -= 1
+            self.calls[label] += 1
+            if self.sampler is None:
+                self.stop_sampling = threading.Event()
+                self.sampler = threading.Thread(target=self._sample, args=(self.stop_sampling,),
+                                                name="profiler", daemon=True)
+                self.sampler.start()
+            depth = self.depth.get(ident, 0)
+            self.depth[ident] = depth + 1
+        if depth == 0:
+            prof = self.profiles.setdefault(ident, cProfile.Profile())
+            try:
+                prof.enable()
+            except ValueError:
+                # 別のプロファイラが動いている (サンプリングだけ続ける)
+                self.profiles.pop(ident, None)
+        return ident
+
+    def exit(self, ident):
+        with self.lock:
+            self.depth[ident] -= 1
+            if self.depth[ident]:
+                return
+            del self.depth[ident]
+        prof = self.profiles.get(ident)
+        if prof is not None:
+            prof.disable()
+        self._finish_if_done()
+
+    def _sample(self, stop):
+        while not stop.wait(self.sample_interval):
+            frames = sys._current_frames()
+            with self.lock:
+                idents = list(self.depth)
+            for ident in idents:
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = collapse_stack(frame)
+                if not stack or is_loop_frame(frame.f_code.co_filename):
+                    self.idle += 1
+                else:
+                    self.samples[stack] += 1
+
+    def _finish_if_done(self):
+        with self.lock:
+            if self.remaining > 0 or self.depth or not self.calls:
+                return None
+            result = self.calls, self.samples, self.idle, list(self.profiles.values())
+            waiters = self.waiters
+            self.calls, self.samples, self.idle, self.profiles, self.waiters = collections.Counter(), collections.Counter(), 0, {}, []
+            sampler, self.sampler = self.sampler, None
+            self.stop_sampling.set()
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # ループ外 (persist の書き込みスレッドなど) ならその場で書き出す
+            return self._complete(sampler, result, waiters)
+        # イベントループ上なら join とファイル書き込みでループを止めないよう別スレッドで
+        self.finishing = asyncio.ensure_future(asyncio.to_thread(self._complete, sampler, result, waiters))
+        return self.finishing
+
+    def _complete(self, sampler, result, waiters):
+        sampler.join()
+        try:
+            self.last = self._write(*result)
+        except Exception as e:
+            self.last = (None, f"⚠ プロファイルの書き出しに失敗しました: {e}")
+        print(f"✅ プロファイル: {self.last[0]}")
+        for loop, fut in waiters:
+            loop.call_soon_threadsafe(lambda f=fut, last=self.last: f.done() or f.set_result(last))
+        return self.last
+
+    def _write(self, calls, samples, idle, profiles):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        label = "-".join(self.targets) if self.targets else "all"
+        base = os.path.join(PROFILE_DIR, f"{datetime.datetime.now(JST):%Y%m%d-%H%M%S}-{label}")
+        lines = ["📈 プロファイル: " + ", ".join(f"{k} x{v}" for k, v in calls.most_common())]
+        stats = None
+        for prof in profiles:
+            try:
+                if stats is None:
+                    stats = pstats.Stats(prof)
+                else:
+                    stats.add(prof)
+            except TypeError:
+                # 一度も関数呼び出しを記録していない
+                continue
+        if stats is not None:
+            stats.dump_stats(f"{base}.pstats")
+            stats.sort_stats("cumulative")
+            lines.append("累積 / 自身 / 呼び出し回数 / 関数 (イベントループの関数を除く)")
+            funcs = [func for func in stats.fcn_list if not is_loop_frame(func[0], func[2])]
+            for func in funcs[:PROFILE_TOP]:
+                _, ncalls, tottime, cumtime, _ = stats.stats[func]
+                filename, line, name = func
+                where = f"{os.path.basename(filename)}:{line}" if line else filename
+                lines.append(f"{cumtime * 1000:.1f}ms / {tottime * 1000:.1f}ms / {ncalls} / {name} ({where})")
+        with open(f"{base}.collapsed", "w", encoding="utf-8") as f:
+            for stack, n in samples.most_common():
+                f.write(f"{stack} {n}\n")
+        leaves = collections.Counter()
+        for stack, n in samples.items():
+            leaves[stack.rsplit(";", 1)[-1]] += n
+        total = sum(samples.values())
+        if total or idle:
+            lines.append(f"サンプル上位 ({total} 件, {self.sample_interval * 1000:.0f}ms 間隔, "
+                         f"ほかにループ待機 {idle} 件 = {idle * 100 / (total + idle):.0f}%)")
+            lines += [f"{n * 100 / total:.0f}% {leaf}" for leaf, n in leaves.most_common(5)]
+        lines.append(f"保存先: {base}.pstats / .collapsed")
+        return base, "\n".join(lines)
+
+    def wait(self):
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        with self.lock:
+            self.waiters.append((loop, fut))
+        return fut
+
+
+profiler = Profiler()
+if PROFILE_NEXT:
+    profiler.arm(PROFILE_NEXT, parse_profile_targets(PROFILE_TARGETS))
+
+# -----------------------------
+# 書き込み遅延 (write-behind)
+# save_* を「変更あり」の印にして、FLUSH_INTERVAL_MS ごと or FLUSH_MAX_MUTATIONS 件ごとに
+# まとめて 1 回だけ書き込む。直列化はイベントループ上で行い (書き込み中に dict が変わっても
+# 中途半端な状態を書かないように)、文字列だけを別スレッドでファイルに書く。
+# 終了時には未書き込み分をすべて書き出す。
+# -----------------------------
+FLUSH_INTERVAL_MS = int(os.getenv("FLUSH_INTERVAL_MS", "500"))
+FLUSH_MAX_MUTATIONS = int(os.getenv("FLUSH_MAX_MUTATIONS", "50"))
+
+
+class WriteBehindFile:
+    def __init__(self, path, interval_ms=FLUSH_INTERVAL_MS, max_mutations=FLUSH_MAX_MUTATIONS,
+                 before_write=None, after_write=None, indent=2):
+        self.path = path
+        self.indent = indent          # None なら空白なしで書く
+        self.obj = None               # 書き込む対象 (最後に mark_dirty で渡されたもの)
+        self.before_write = before_write  # 書き込み直前にイベントループ上で呼ぶ。戻り値は after_write に渡る
+        self.after_write = after_write    # 書き込み成功後に呼ぶ
+        self.interval = interval_ms / 1000
+        self.max_mutations = max_mutations
+        self.pending = 0              # 未書き込みの変更数
+        self.timer = None             # loop.call_later のハンドル
+        self.task = None              # 実行中の書き込みタスク
+        self.requested = 0            # save_* が呼ばれた回数
+        self.flushes = 0              # 実際に書き込んだ回数
+
+    def mark_dirty(self, obj):
+        self.obj = obj
+        self.requested += 1
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # イベントループ外 (起動前・終了後) は即時書き込み
+            self.flush_sync()
+            return
+        if self.pending >= self.max_mutations:
+            self._start_flush(loop)
+        elif self.timer is None and self.task is None:
+            self.timer = loop.call_later(self.interval, self._start_flush, loop)
+
+    def _start_flush(self, loop):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        # 書き込み中なら完了後に改めてスケジュールする
+        if self.task is not None or not self.pending:
+            return
+        self.pending = 0
+        token = self.before_write() if self.before_write else None
+        try:
+            text = self._serialize()
+        except Exception as e:
+            print(f"⚠ write-behind serialize error {self.path}: {e}")
+            self.pending += 1
+            return
+        self.task = loop.create_task(self._flush(token, text))
+
+    async def _flush(self, token, text):
+        try:
+            await asyncio.to_thread(self._write, token, text)
+        except Exception as e:
+            print(f"⚠ write-behind flush error {self.path}: {e}")
+            self.pending += 1
+        finally:
+            self.task = None
+            if self.pending and self.timer is None:
+                loop = asyncio.get_running_loop()
+                self.timer = loop.call_later(self.interval, self._start_flush, loop)
+
+    def _serialize(self):
+        # 呼び出したスレッド (通常はイベントループ) でその時点のスナップショットを文字列にする
+        prof = profiler.enter(f"persist:{os.path.basename(self.path)}")
+        try:
+            return dump_json(self.obj, self.indent)
+        finally:
+            if prof is not None:
+                profiler.exit(prof)
+
+    def _write(self, token, text):
+        t0 = time.perf_counter()
+        prof = profiler.enter(f"persist:{os.path.basename(self.path)}:write")
+        try:
+            write_json_atomic(self.path, text)
+        finally:
+            if prof is not None:
+                profiler.exit(prof)
+        state_cache.refresh(self.path, file_signature(self.path), self.obj)
+        metrics.observe("persist_flush_seconds", time.perf_counter() - t0, file=os.path.basename(self.path))
+        self.flushes += 1
+        if self.after_write:
+            self.after_write(token)
+
+    def flush_sync(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        # 書き込みタスクが途中で止まった場合も含めて書き出す
+        if not self.pending and self.task is None:
+            return
+        try:
+            token = self.before_write() if self.before_write else None
+            self._write(token, self._serialize())
+            self.pending = 0
+        except Exception as e:
+            print(f"⚠ write-behind flush error {self.path}: {e}")
+
+    def stats(self):
+        return {
+            "requested": self.requested,
+            "flushes": self.flushes,
+            "saved": self.requested - self.flushes,
+            "pending": self.pending,
+        }
+
+
+# -----------------------------
+# 投票レコード
+# ステータスは STATUSES の添字 (0/1/2) で持ち、表示名は user_names にユーザーごと 1 回だけ持つ。
+# (message_id, date) ごとに user_id -> ステータスコード と人数を持ち、
+# トグル・切り替え・取り消しを投票人数に関係なく定数時間で行う。
+# -----------------------------
+STATUSES = ("参加(🟢)", "オンライン可(🟡)", "不可(🔴)")
+YES, MAYBE, NO = range(len(STATUSES))
+STATUS_CODES = {label: code for code, label in enumerate(STATUSES)}   # 旧形式の読み込み用
+LEVELS = ("初級", "中級")     # 級 (Step1 のチャンネル・出欠集計の単位)
+
+user_names = {}     # user_id -> 表示名 (全メッセージ・全日程で共有)
+
+
+class VoteRecord:
+    __slots__ = ("users", "counts", "version")
+
+    def __init__(self, users=None):
+        self.users = {} if users is None else users   # user_id -> ステータスコード
+        self.counts = [0] * len(STATUSES)
+        for code in self.users.values():
+            self.counts[code] += 1
+        self.version = 0              # 変更のたびに増える (Step2 の差分判定用)
+
+    def set(self, user_id, code):
+        # 結果の状態をそのまま反映する (code=None は取り消し)
+        self.version += 1
+        current = self.users.pop(user_id, None)
+        if current is not None:
+            self.counts[current] -= 1
+        if code is not None:
+            self.users[user_id] = code
+            self.counts[code] += 1
+
+    def toggle(self, user_id, code):
+        # 同じステータスを押したら取り消し、違うステータスなら切り替え。新しいステータスを返す (取り消しは None)
+        new = None if self.users.get(user_id) == code else code
+        self.set(user_id, new)
+        return new
+
+    def names(self, code):
+        return [user_names.get(uid, uid) for uid, c in self.users.items() if c == code]
+
+
+def decode_vote_record(raw, users):
+    # 新形式 {user_id: code} と旧形式 {ステータス名: {user_id: 表示名}} のどちらも読む
+    codes = {}
+    for key, value in raw.items():
+        if isinstance(value, dict):
+            code = STATUS_CODES.get(key)
+            if code is None:
+                continue
+            for uid, name in value.items():
+                codes[uid] = code
+                if name:
+                    users[uid] = name
+        else:
+            codes[key] = value
+    return VoteRecord(codes)
+
+
+def decode_vote_entry(entry, users):
+    return {k: (v if k in META_KEYS else decode_vote_record(v, users)) for k, v in entry.items()}
+
+
+META_KEYS = ("channel", "guild", "level")
+
+
+def entry_dates(entry):
+    # vote_data の 1 エントリから日付キーだけを取り出す
+    return [k for k in entry if k not in META_KEYS]
+
+# -----------------------------
+# 投票ジャーナル (追記専用)
+# 1 クリック = 1 行の追記にして、votes.json (スナップショット) の書き直しは圧縮時だけにする。
+# 圧縮: ジャーナルを退避 → スナップショットを書く → 退避分を削除。
+# 起動時はスナップショット + 残っているジャーナルを順に再生して復元する。
+# イベントは「結果の状態」を記録するので、同じイベントを 2 回再生しても結果は変わらない。
+# votes.json が壊れていたら votes.json.corrupt-<日時> に退避し、その退避ファイルが残っている間は
+# 圧縮しない (ジャーナルだけに追記し続け、空の状態で上書きして投票を失わないようにする)。
+# 復旧したら (votes.json を戻すか不要と確認して) 退避ファイルを消すと圧縮を再開する。
+# -----------------------------
+JOURNAL_FILE = os.path.join(DATA_DIR, "votes.journal")
+JOURNAL_COMPACT_EVENTS = int(os.getenv("JOURNAL_COMPACT_EVENTS", "500"))
+JOURNAL_COMPACT_SEC = int(os.getenv("JOURNAL_COMPACT_SEC", "60"))
+
+
+class VoteJournal:
+    def __init__(self, path):
+        self.path = path
+        self.fp = None
+        self.events = 0      # 現在のジャーナルの行数
+
+    def append(self, event):
+        if self.fp is None:
+            self.fp = open(self.path, "a", encoding="utf-8")
+        self.fp.write(json.dumps(event, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self.fp.flush()
+        self.events += 1
+
+    def rotated_segments(self):
+        prefix = os.path.basename(self.path) + "."
+        segs = []
+        for name in os.listdir(os.path.dirname(self.path) or "."):
+            suffix = name[len(prefix):]
+            if name.startswith(prefix) and suffix.isdigit():
+                segs.append((int(suffix), os.path.join(os.path.dirname(self.path), name)))
+        return [p for _, p in sorted(segs)]
+
+    def rotate(self):
+        # 現在のジャーナルを退避して、これまでに退避された分も含めたリストを返す
+        if self.fp:
+            self.fp.close()
+            self.fp = None
+        if os.path.exists(self.path):
+            os.replace(self.path, f"{self.path}.{time.time_ns()}")
+        self.events = 0
+        return self.rotated_segments()
+
+    def drop(self, segments):
+        for seg in segments or ():
+            try:
+                os.remove(seg)
+            except FileNotFoundError:
+                pass
+
+    def replay(self, data, users):
+        count = 0
+        for seg in self.rotated_segments() + [self.path]:
+            try:
+                f = open(seg, "r", encoding="utf-8")
+            except FileNotFoundError:
+                continue
+            with f:
+                for line in f:
+                    try:
+                        ev = json.loads(line)
+                    except ValueError:
+                        # 書き込み途中で落ちた最終行などは捨てる
+                        continue
+                    apply_vote_event(data, users, ev)
+                    count += 1
+        return count
+
+
+def apply_vote_event(data, users, ev):
+    op = ev.get("op")
+    if op == "user":
+        users[ev["u"]] = ev["n"]
+        return
+    if op == "drop":
+        data.pop(ev["m"], None)
+        return
+    entry = data.setdefault(ev["m"], {})
+    if op == "msg":
+        entry["channel"] = ev["c"]
+        if ev.get("g") is not None:
+            entry["guild"] = ev["g"]
+        if ev.get("l") is not None:
+            entry["level"] = ev["l"]
+        entry.setdefault(ev["d"], VoteRecord())
+        return
+    rec = entry.setdefault(ev["d"], VoteRecord())
+    if op == "set":
+        status = ev["s"]
+        if isinstance(status, str):
+            # 旧形式のジャーナル (ステータス名 + 表示名)
+            status = STATUS_CODES[status]
+            users[ev["u"]] = ev["n"]
+        rec.set(ev["u"], status)
+    else:
+        rec.set(ev["u"], None)
+
+# -----------------------------
+# ストレージ
+# vote_data / confirmed / locations の永続化先を切り替えられるようにする。
+# STORAGE_BACKEND=json (既定: JSON + ジャーナル) / sqlite (WAL, 1 投票 = 1 行 upsert)
+# どちらも作業用の dict はメモリ上に持ち、変更を永続化するだけ。
+# -----------------------------
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")
+SQLITE_FILE = os.path.join(DATA_DIR, "bot.sqlite3")
+# votes.json の形式: {"version": 2, "users": {user_id: 表示名}, "messages": {message_id: {..., date: {user_id: code}}}}
+# version のない旧形式 (message_id -> {date: {ステータス名: {user_id: 表示名}}}) は読み込み時に移行する
+VOTE_FORMAT_VERSION = 2
+
+
+class Storage(abc.ABC):
+    name = "base"
+
+    @abc.abstractmethod
+    def load_votes(self, users):
+        # vote_data を返し、ユーザー表は渡された users に読み込む
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def save_votes(self, vote_data):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def record_vote(self, vote_data, message_id, date_str, user_id, status):
+        # status=None は取り消し。vote_data はすでに更新済みで渡される
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def record_user(self, vote_data, user_id, user_name):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def record_message(self, vote_data, message_id, channel_id, date_str, guild_id=None, level=None):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_messages(self, vote_data, message_ids):
+        # vote_data からはすでに取り除かれた状態で渡される
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_confirmed(self, confirmed, keys):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def load_confirmed(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def save_confirmed(self, confirmed, key=None):
+        # key を指定するとその 1 件だけを保存すればよい
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def load_locations(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def save_locations(self, locations):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def stats(self):
+        return {}
+
+
+class JSONStorage(Storage):
+    name = "json"
+
+    def __init__(self):
+        self.journal = VoteJournal(JOURNAL_FILE)
+        self.votes_file = WriteBehindFile(VOTE_FILE,
+                                          interval_ms=JOURNAL_COMPACT_SEC * 1000,
+                                          max_mutations=JOURNAL_COMPACT_EVENTS,
+                                          before_write=self.journal.rotate,
+                                          after_write=self.journal.drop,
+                                          indent=None)
+        self.users = {}
+        self.locations_file = WriteBehindFile(LOC_FILE)
+        self.confirmed_file = WriteBehindFile(CONFIRMED_FILE)
+        self.files = (self.votes_file, self.locations_file, self.confirmed_file)
+        self.compaction_blocked = False
+
+    def corrupt_snapshots(self):
+        prefix = os.path.basename(VOTE_FILE) + ".corrupt-"
+        try:
+            return sorted(n for n in os.listdir(os.path.dirname(VOTE_FILE) or ".") if n.startswith(prefix))
+        except FileNotFoundError:
+            return []
+
+    def _read_snapshot(self):
+        try:
+            with open(VOTE_FILE, "r", encoding="utf-8") as f:
+                raw = json.load(f)
+            if not isinstance(raw, dict):
+                raise ValueError(f"オブジェクトではありません ({type(raw).__name__})")
+            return raw
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            aside = f"{VOTE_FILE}.corrupt-{datetime.datetime.now(JST):%Y%m%d-%H%M%S}"
+            os.replace(VOTE_FILE, aside)
+            print(f"⚠ votes.json を読めません ({e})。{aside} に退避しました")
+            return {}
+
+    def load_votes(self, users):
+        self.users = users
+        raw = self._read_snapshot()
+        corrupt = self.corrupt_snapshots()
+        self.compaction_blocked = bool(corrupt)
+        if corrupt:
+            print(f"⚠ 退避した votes.json ({', '.join(corrupt)}) があるので、ジャーナルを votes.json に圧縮しません。"
+                  "復旧したら退避ファイルを削除してください")
+        legacy = raw.get("version") != VOTE_FORMAT_VERSION
+        if legacy:
+            messages = raw
+        else:
+            users.update(raw.get("users", {}))
+            messages = raw.get("messages", {})
+        data = {msg_id: decode_vote_entry(entry, users) for msg_id, entry in messages.items()}
+        replayed = self.journal.replay(data, users)
+        if replayed:
+            print(f"✅ ジャーナル再生: {replayed} 件")
+        if legacy and messages:
+            # 旧形式は一度だけ .v1.bak として残してから新形式で書き直す
+            backup = f"{VOTE_FILE}.v1.bak"
+            if not os.path.exists(backup):
+                os.replace(VOTE_FILE, backup)
+            print(f"✅ votes.json を新形式 (version {VOTE_FORMAT_VERSION}) に移行しました: 投票メッセージ {len(data)} 件")
+        if replayed or (legacy and messages):
+            # 再生・移行した分はすぐスナップショットに畳み込んでおく
+            self.save_votes(data)
+        return data
+
+    def save_votes(self, vote_data):
+        if self.compaction_blocked:
+            # ジャーナルには追記済み。スナップショットで上書きしない
+            return
+        self.votes_file.mark_dirty({"version": VOTE_FORMAT_VERSION, "users": self.users, "messages": vote_data})
+
+    def record_vote(self, vote_data, message_id, date_str, user_id, status):
+        if status is None:
+            self.journal.append({"op": "clear", "m": message_id, "d": date_str, "u": user_id})
+        else:
+            self.journal.append({"op": "set", "m": message_id, "d": date_str, "u": user_id, "s": status})
+        self.save_votes(vote_data)
+
+    def record_user(self, vote_data, user_id, user_name):
+        self.journal.append({"op": "user", "u": user_id, "n": user_name})
+        self.save_votes(vote_data)
+
+    def record_message(self, vote_data, message_id, channel_id, date_str, guild_id=None, level=None):
+        self.journal.append({"op": "msg", "m": message_id, "c": channel_id, "g": guild_id, "l": level, "d": date_str})
+        self.save_votes(vote_data)
+
+    def delete_messages(self, vote_data, message_ids):
+        for msg_id in message_ids:
+            self.journal.append({"op": "drop", "m": msg_id})
+        self.save_votes(vote_data)
+
+    def delete_confirmed(self, confirmed, keys):
+        self.save_confirmed(confirmed)
+
+    def _load_cached(self, wb):
+        # 書き込み待ちの変更があればメモリ上の方が新しい
+        return state_cache.get(wb.path, file_signature(wb.path), lambda: load_json(wb.path, {}),
+                               pinned=bool(wb.pending or wb.task))
+
+    def load_confirmed(self):
+        return self._load_cached(self.confirmed_file)
+
+    def save_confirmed(self, confirmed, key=None):
+        self.confirmed_file.mark_dirty(confirmed)
+
+    def load_locations(self):
+        return self._load_cached(self.locations_file)
+
+    def save_locations(self, locations):
+        self.locations_file.mark_dirty(locations)
+
+    def flush(self):
+        for wb in self.files:
+            wb.flush_sync()
+
+    def stats(self):
+        return {os.path.basename(wb.path): wb.stats() for wb in self.files}
+
+
+class SQLiteStorage(Storage):
+    name = "sqlite"
+    VOTES_TABLE = """
+        CREATE TABLE IF NOT EXISTS votes (
+            message_id TEXT NOT NULL,
+            date TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            status INTEGER NOT NULL,
+            PRIMARY KEY (message_id, date, user_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_votes_user ON votes (user_id);
+    """
+    SCHEMA = VOTES_TABLE + """
+        CREATE TABLE IF NOT EXISTS vote_messages (
+            message_id TEXT NOT NULL,
+            date TEXT NOT NULL,
+            channel_id INTEGER,
+            PRIMARY KEY (message_id, date)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_vote_messages_channel ON vote_messages (channel_id, date);
+        CREATE INDEX IF NOT EXISTS idx_vote_messages_date ON vote_messages (date);
+        CREATE TABLE IF NOT EXISTS users (
+            user_id TEXT PRIMARY KEY,
+            name TEXT NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS confirmed (
+            key TEXT PRIMARY KEY,
+            info TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS locations (
+            scope TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            PRIMARY KEY (scope, position)
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    def __init__(self, path=SQLITE_FILE):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+        # サーバー別運用の追加カラム (古い DB にも追加する)
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(vote_messages)")}
+        if "guild_id" not in columns:
+            self.db.execute("ALTER TABLE vote_messages ADD COLUMN guild_id INTEGER")
+        if "level" not in columns:
+            self.db.execute("ALTER TABLE vote_messages ADD COLUMN level TEXT")
+        self.db.execute("CREATE INDEX IF NOT EXISTS idx_vote_messages_guild ON vote_messages (guild_id, channel_id, date)")
+        if "user_name" in {row[1] for row in self.db.execute("PRAGMA table_info(votes)")}:
+            self.migrate_votes_v1()
+        self.writes = 0
+        self.migrate_from_json()
+
+    def migrate_votes_v1(self):
+        # 旧 votes (ステータス名 + 表示名を 1 行ごとに持つ) をステータスコード + users 表に移す
+        cases = " ".join(f"WHEN ? THEN {code}" for code in range(len(STATUSES)))
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO users SELECT user_id, user_name FROM votes WHERE user_name IS NOT NULL")
+            self.db.execute("ALTER TABLE votes RENAME TO votes_v1")
+            self.db.execute("DROP INDEX IF EXISTS idx_votes_user")
+            for stmt in self.VOTES_TABLE.split(";"):
+                if stmt.strip():
+                    self.db.execute(stmt)
+            self.db.execute(f"INSERT INTO votes SELECT message_id, date, user_id, CASE status {cases} END "
+                            f"FROM votes_v1 WHERE status IN ({', '.join('?' * len(STATUSES))})",
+                            STATUSES + STATUSES)
+            self.db.execute("DROP TABLE votes_v1")
+        print("✅ SQLite の votes をステータスコード形式に移行しました")
+
+    def migrate_from_json(self):
+        # 初回のみ data/*.json (+ ジャーナル) を取り込む。JSON ファイルはバックアップとして残す
+        if self.db.execute("SELECT 1 FROM meta WHERE key = 'migrated_from_json'").fetchone():
+            return
+        src = JSONStorage()
+        users = {}
+        vote_data = src.load_votes(users)
+        with self.db:
+            for msg_id, data in vote_data.items():
+                for date_str in entry_dates(data):
+                    self.db.execute("INSERT OR REPLACE INTO vote_messages (message_id, date, channel_id, guild_id, level) "
+                                    "VALUES (?, ?, ?, ?, ?)",
+                                    (msg_id, date_str, data.get("channel"), data.get("guild"), data.get("level")))
+                    self.db.executemany("INSERT OR REPLACE INTO votes VALUES (?, ?, ?, ?)",
+                                        [(msg_id, date_str, uid, code) for uid, code in data[date_str].users.items()])
+            self.db.executemany("INSERT OR REPLACE INTO users VALUES (?, ?)", users.items())
+            self._write_confirmed(src.load_confirmed())
+            self._write_locations(src.load_locations())
+            self.db.execute("INSERT INTO meta VALUES ('migrated_from_json', ?)",
+                            (datetime.datetime.now(JST).isoformat(),))
+        print(f"✅ JSON から SQLite へ移行しました: 投票メッセージ {len(vote_data)} 件")
+
+    def load_votes(self, users):
+        data = {}
+        for msg_id, date_str, channel_id, guild_id, level in self.db.execute(
+                "SELECT message_id, date, channel_id, guild_id, level FROM vote_messages"):
+            entry = data.setdefault(msg_id, {"channel": channel_id})
+            if guild_id is not None:
+                entry["guild"] = guild_id
+            if level is not None:
+                entry["level"] = level
+            entry[date_str] = {}
+        for msg_id, date_str, user_id, status in self.db.execute("SELECT message_id, date, user_id, status FROM votes"):
+            data.setdefault(msg_id, {}).setdefault(date_str, {})[user_id] = status
+        for entry in data.values():
+            for date_str in entry_dates(entry):
+                entry[date_str] = VoteRecord(entry[date_str])
+        users.update(self.db.execute("SELECT user_id, name FROM users"))
+        return data
+
+    def save_votes(self, vote_data):
+        # 投票は record_* で 1 行ずつ書いているので全体の書き直しは不要
+        pass
+
+    def record_vote(self, vote_data, message_id, date_str, user_id, status):
+        with self.db:
+            if status is None:
+                self.db.execute("DELETE FROM votes WHERE message_id = ? AND date = ? AND user_id = ?",
+                                (message_id, date_str, user_id))
+            else:
+                self.db.execute(
+                    "INSERT INTO votes VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (message_id, date, user_id) DO UPDATE SET status = excluded.status",
+                    (message_id, date_str, user_id, status))
+        self.writes += 1
+
+    def record_user(self, vote_data, user_id, user_name):
+        with self.db:
+            self.db.execute("INSERT INTO users VALUES (?, ?) ON CONFLICT (user_id) DO UPDATE SET name = excluded.name",
+                            (user_id, user_name))
+        self.writes += 1
+
+    def record_message(self, vote_data, message_id, channel_id, date_str, guild_id=None, level=None):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO vote_messages (message_id, date, channel_id, guild_id, level) "
+                            "VALUES (?, ?, ?, ?, ?)",
+                            (message_id, date_str, channel_id, guild_id, level))
+        self.writes += 1
+
+    def delete_messages(self, vote_data, message_ids):
+        rows = [(msg_id,) for msg_id in message_ids]
+        with self.db:
+            self.db.executemany("DELETE FROM votes WHERE message_id = ?", rows)
+            self.db.executemany("DELETE FROM vote_messages WHERE message_id = ?", rows)
+        self.writes += 1
+
+    def delete_confirmed(self, confirmed, keys):
+        with self.db:
+            self.db.executemany("DELETE FROM confirmed WHERE key = ?", [(k,) for k in keys])
+        self.writes += 1
+
+    def _load_cached(self, table, load):
+        # data_version は他の接続 (外部ツール等) がコミットした時だけ変わる。自分の書き込みはメモリ上に反映済み
+        version = self.db.execute("PRAGMA data_version").fetchone()[0]
+        return state_cache.get(f"{self.path}:{table}", version, load)
+
+    def load_confirmed(self):
+        return self._load_cached("confirmed", lambda: {
+            key: json.loads(info) for key, info in self.db.execute("SELECT key, info FROM confirmed")})
+
+    def _write_confirmed(self, confirmed, key=None):
+        items = [(key, confirmed[key])] if key is not None and key in confirmed else confirmed.items()
+        self.db.executemany("INSERT OR REPLACE INTO confirmed VALUES (?, ?)",
+                            [(k, json.dumps(v, ensure_ascii=False)) for k, v in items])
+
+    def save_confirmed(self, confirmed, key=None):
+        with self.db:
+            self._write_confirmed(confirmed, key)
+        self.writes += 1
+
+    def load_locations(self):
+        return self._load_cached("locations", self._read_locations)
+
+    def _read_locations(self):
+        locs = {}
+        for scope, name in self.db.execute("SELECT scope, name FROM locations ORDER BY scope, position"):
+            locs.setdefault(scope, []).append(name)
+        return locs
+
+    def _write_locations(self, locations):
+        self.db.execute("DELETE FROM locations")
+        self.db.executemany("INSERT INTO locations VALUES (?, ?, ?)",
+                            [(scope, i, name) for scope, names in locations.items() for i, name in enumerate(names)])
+
+    def save_locations(self, locations):
+        with self.db:
+            self._write_locations(locations)
+        self.writes += 1
+
+    def flush(self):
+        self.db.commit()
+
+    def stats(self):
+        return {os.path.basename(self.path): {"writes": self.writes}}
+
+
+def make_storage(backend=STORAGE_BACKEND):
+    if backend == "sqlite":
+        return SQLiteStorage()
+    if backend != "json":
+        print(f"⚠ 不明な STORAGE_BACKEND={backend}。json を使います")
+    return JSONStorage()
+
+
+storage = make_storage()
+
+
+def flush_all():
+    storage.flush()
+
+
+def persist_stats():
+    return storage.stats()
+
+
+@atexit.register
+def _flush_on_exit():
+    flush_all()
+    for name, st in persist_stats().items():
+        if st.get("requested"):
+            print(f"💾 {name}: 保存要求 {st['requested']} 回 / 書き込み {st['flushes']} 回 (削減 {st['saved']} 回)")
 
 
 def load_votes():
     global vote_data
-    vote_data = load_json(VOTE_FILE, {})
+    user_names.clear()
+    vote_data = storage.load_votes(user_names)
+    vote_index.rebuild(vote_data)
+    digest_versions.clear()
 
 
 def save_votes():
-    save_json(VOTE_FILE, vote_data)
+    storage.save_votes(vote_data)
+
+
+def record_vote(message_id, date_str, user_id, status=None):
+    # status=None は取り消し
+    storage.record_vote(vote_data, message_id, date_str, user_id, status)
+
+
+def remember_user(user_id, user_name):
+    # 表示名が変わった時だけユーザー表を更新する
+    if user_name and user_names.get(user_id) != user_name:
+        user_names[user_id] = user_name
+        storage.record_user(vote_data, user_id, user_name)
+
+
+def record_vote_message(message_id, channel_id, date_str, guild_id=None, level=None):
+    # vote_data に入れた後で呼ぶ
+    vote_index.add(message_id, vote_data[message_id])
+    storage.record_message(vote_data, message_id, channel_id, date_str, guild_id, level)
 
 
 def load_locations():
     global locations
-    locations = load_json(LOC_FILE, {})
+    locations = storage.load_locations()
     return locations
 
 
 def save_locations():
-    save_json(LOC_FILE, locations)
+    storage.save_locations(locations)
+
+
+def guild_locations(guild_id, create=False):
+    # サーバー別のスタジオ一覧。未登録なら旧形式の "共通" を使う (変更時はサーバー用にコピーする)
+    # guild_id が None (DM からの /place) なら "共通" そのもの
+    if guild_id is None:
+        return locations.setdefault("共通", []) if create else locations.get("共通", [])
+    key = str(guild_id)
+    if key in locations:
+        return locations[key]
+    shared = locations.get("共通", [])
+    if not create:
+        return shared
+    locations[key] = list(shared)
+    return locations[key]
 
 
 def load_confirmed():
+    # 参照する直前に呼ぶ。ファイル (DB) が外から変わっていなければキャッシュをそのまま返すので軽い
     global confirmed
-    confirmed = load_json(CONFIRMED_FILE, {})
+    confirmed = storage.load_confirmed()
     return confirmed
 
 
-def save_confirmed():
-    save_json(CONFIRMED_FILE, confirmed)
+def save_confirmed(key=None):
+    storage.save_confirmed(confirmed, key)
 
-# 初期ロード
-load_votes()
-load_locations()
-load_confirmed()
+
+# Step2 の差分通知: (message_id, date) -> 前回の通知に載せた時の VoteRecord.version
+# (再起動直後は空なので、最初の通知では全日程が「変更あり」になる)
+digest_versions = {}
+
+
+def get_vote_record(message_id, date_str):
+    entry = vote_data.get(message_id)
+    return entry.get(date_str) if entry is not None else None
 
 # -----------------------------
 # 日付処理
@@ -114,6 +1309,18 @@ def generate_week_schedule(start):
     ]
 
 
+def parse_vote_date(date_str):
+    # "YYYY-MM-DD (曜)" -> datetime.date (読めなければ None)
+    try:
+        return datetime.date.fromisoformat(date_str[:10])
+    except (TypeError, ValueError):
+        return None
+
+
+def today_jst():
+    return datetime.datetime.now(JST).date()
+
+
 def get_week_name(date):
     # date は datetime
     month = date.month
@@ -123,12 +1330,674 @@ def get_week_name(date):
     return f"{month}月第{week_number}週"
 
 # -----------------------------
-# ユーティリティ
+# 保持期間とアーカイブ
+# 全日程が RETENTION_DAYS 日より前になった投票メッセージは vote_data / confirmed から外し、
+# data/archive/<ISO週>.ndjson.gz に 1 メッセージ 1 行で追記する (gzip のメンバー連結)。
+# 読み返し: python bot.py archive list / python bot.py archive show 2025-W49
+# -----------------------------
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "0"))
+ARCHIVE_DIR = os.path.join(DATA_DIR, "archive")
+
+
+def archive_week_key(date):
+    year, week, _ = date.isocalendar()
+    return f"{year}-W{week:02d}"
+
+
+def entry_last_date(entry):
+    dates = [d for d in map(parse_vote_date, entry_dates(entry)) if d]
+    return max(dates) if dates else None
+
+
+def retention_cutoff(today=None):
+    return (today or today_jst()) - datetime.timedelta(days=RETENTION_DAYS)
+
+
+def is_active_date(date_str, today=None):
+    d = parse_vote_date(date_str)
+    if d is None:
+        return True
+    return d >= retention_cutoff(today)
+
+
+def archive_expired(today=None):
+    load_confirmed()
+    cutoff = retention_cutoff(today)
+    expired = {}
+    # 最終日が cutoff より前なら、全日程が cutoff の週以前にある
+    for msg_id in vote_index.messages_until(archive_week_key(cutoff)):
+        entry = vote_data[msg_id]
+        last = entry_last_date(entry)
+        if last is not None and last < cutoff:
+            expired[msg_id] = last
+    if not expired:
+        return 0
+
+    confirmed_by_msg = {}
+    for key in confirmed:
+        msg_id = key.split("|", 1)[0]
+        if msg_id in expired:
+            confirmed_by_msg.setdefault(msg_id, []).append(key)
+
+    by_week = {}
+    archived_at = datetime.datetime.now(JST).isoformat()
+    for msg_id, last in expired.items():
+        entry = vote_data[msg_id]
+        record = {
+            "message_id": msg_id,
+            "entry": entry,
+            "users": {uid: user_names[uid] for d in entry_dates(entry) for uid in entry[d].users if uid in user_names},
+            "confirmed": {k: confirmed[k] for k in confirmed_by_msg.get(msg_id, [])},
+            "archived_at": archived_at,
+        }
+        by_week.setdefault(archive_week_key(last), []).append((msg_id, json.dumps(record, ensure_ascii=False, default=json_default)))
+
+    # 前回が追記の後 (ホットデータから外す前) に落ちていれば、同じメッセージがもう書いてあるので飛ばす
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    for week, lines in by_week.items():
+        written = archived_message_ids(week)
+        lines = [line for msg_id, line in lines if msg_id not in written]
+        if not lines:
+            continue
+        with gzip.open(os.path.join(ARCHIVE_DIR, f"{week}.ndjson.gz"), "at", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+    # 集計は live 側ではもう数えてあるので、アーカイブ済みの分として base に移すだけ。
+    # base に入れた message_id も rollups.json に残し、やり直しでも二重に数えない
+    for msg_id in expired:
+        if msg_id in attendance_base.archived:
+            continue
+        attendance_base.add_entry(vote_data[msg_id])
+        for k in confirmed_by_msg.get(msg_id, []):
+            attendance_base.add_confirmed(k, confirmed[k])
+        attendance_base.archived.add(msg_id)
+    save_rollup_base()
+
+    # アーカイブに書けたものだけホットデータから外す
+    for msg_id in expired:
+        entry = vote_data.pop(msg_id)
+        vote_index.remove(msg_id, entry)
+        for date_str in entry_dates(entry):
+            digest_versions.pop((msg_id, date_str), None)
+    storage.delete_messages(vote_data, list(expired))
+    keys = [k for ks in confirmed_by_msg.values() for k in ks]
+    for k in keys:
+        del confirmed[k]
+    if keys:
+        storage.delete_confirmed(confirmed, keys)
+    print(f"✅ アーカイブ: {len(expired)} 件の投票メッセージを {', '.join(sorted(by_week))} に移動しました")
+    return len(expired)
+
+
+async def run_retention():
+    # スケジューラからはコルーチンとして呼ぶ (同期関数だと別スレッドで vote_data を触ってしまう)
+    archive_expired()
+
+
+def archive_weeks():
+    try:
+        names = os.listdir(ARCHIVE_DIR)
+    except FileNotFoundError:
+        return []
+    return sorted(n[:-len(".ndjson.gz")] for n in names if n.endswith(".ndjson.gz"))
+
+
+def read_archive(week):
+    path = os.path.join(ARCHIVE_DIR, f"{week}.ndjson.gz")
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def archived_message_ids(week):
+    try:
+        return {rec["message_id"] for rec in read_archive(week)}
+    except FileNotFoundError:
+        return set()
+
+
+def archive_cli(argv):
+    if not argv or argv[0] == "list":
+        for week in archive_weeks():
+            print(week)
+    elif argv[0] == "show" and len(argv) >= 2:
+        for rec in read_archive(argv[1]):
+            print(json.dumps(rec, ensure_ascii=False))
+    else:
+        print("使い方: python bot.py archive list | python bot.py archive show <YYYY-Www>")
+
+# -----------------------------
+# 投票メッセージの索引
+# vote_data は message_id でしか引けないので、チャンネル・ISO週・級・サーバーからの索引を別に持つ。
+# 読み込み時に作り、Step1 の記録 (record_vote_message) とアーカイブ時に差分で更新する。
+# Step2/3・保持期間・View の復元は対象の週のメッセージだけを見る。
+# Step2/3 はサーバーごとに動くので、週の索引はサーバー別にも持つ (全サーバー分を毎回絞り込まない)。
+# -----------------------------
+class WeekBuckets:
+    def __init__(self):
+        self.by_week = {}          # ISO週 -> {message_id}
+        self.undated = set()       # 日付を読めない日程を持つメッセージ (常に対象にする)
+        self.week_keys = []        # by_week のキーの昇順
+
+    def __bool__(self):
+        return bool(self.by_week or self.undated)
+
+    def add(self, msg_id, weeks):
+        for week in weeks:
+            if week is None:
+                self.undated.add(msg_id)
+                continue
+            if week not in self.by_week:
+                bisect.insort(self.week_keys, week)
+                self.by_week[week] = set()
+            self.by_week[week].add(msg_id)
+
+    def remove(self, msg_id, weeks):
+        self.undated.discard(msg_id)
+        for week in weeks:
+            msgs = self.by_week.get(week)
+            if msgs is None:
+                continue
+            msgs.discard(msg_id)
+            if not msgs:
+                del self.by_week[week]
+                self.week_keys.remove(week)
+
+    def since(self, week):
+        # week 以降 (week を含む) の週のメッセージ + 日付不明のもの
+        msgs = set(self.undated)
+        for w in self.week_keys[bisect.bisect_left(self.week_keys, week):]:
+            msgs |= self.by_week[w]
+        return msgs
+
+    def until(self, week):
+        # week 以前 (week を含む) の週のメッセージ
+        msgs = set()
+        for w in self.week_keys[:bisect.bisect_right(self.week_keys, week)]:
+            msgs |= self.by_week[w]
+        return msgs
+
+
+class VoteIndex:
+    def __init__(self):
+        self.by_channel = {}       # channel_id -> {message_id}
+        self.weeks = WeekBuckets()         # 全サーバー分
+        self.guild_weeks = {}      # guild_id (未記録なら None) -> WeekBuckets
+        self.level_channels = {}   # 級 -> {channel_id}
+
+    def _weeks(self, entry):
+        weeks = set()
+        for date_str in entry_dates(entry):
+            d = parse_vote_date(date_str)
+            weeks.add(archive_week_key(d) if d else None)
+        return weeks
+
+    def add(self, msg_id, entry):
+        channel_id = entry.get("channel")
+        self.by_channel.setdefault(channel_id, set()).add(msg_id)
+        weeks = self._weeks(entry)
+        self.weeks.add(msg_id, weeks)
+        self.guild_weeks.setdefault(entry.get("guild"), WeekBuckets()).add(msg_id, weeks)
+        if entry.get("level") and channel_id is not None:
+            self.level_channels.setdefault(entry["level"], set()).add(channel_id)
+
+    def remove(self, msg_id, entry):
+        channel_id = entry.get("channel")
+        msgs = self.by_channel.get(channel_id)
+        if msgs is not None:
+            msgs.discard(msg_id)
+            if not msgs:
+                del self.by_channel[channel_id]
+                for channels in self.level_channels.values():
+                    channels.discard(channel_id)
+        weeks = self._weeks(entry)
+        self.weeks.remove(msg_id, weeks)
+        guild_id = entry.get("guild")
+        buckets = self.guild_weeks.get(guild_id)
+        if buckets is not None:
+            buckets.remove(msg_id, weeks)
+            if not buckets:
+                del self.guild_weeks[guild_id]
+
+    def rebuild(self, vote_data):
+        self.__init__()
+        for msg_id, entry in vote_data.items():
+            self.add(msg_id, entry)
+
+    def channel_messages(self, channel_id):
+        return self.by_channel.get(channel_id, ())
+
+    def channel_level(self, channel_id):
+        for level, channels in self.level_channels.items():
+            if channel_id in channels:
+                return level
+        return None
+
+    def messages_since(self, week):
+        return self.weeks.since(week)
+
+    def messages_until(self, week):
+        return self.weeks.until(week)
+
+    def guild_messages_since(self, guild_id, week):
+        # そのサーバー + サーバー未記録の古いデータの、week 以降のメッセージ
+        msgs = set()
+        for key in {guild_id, None}:
+            buckets = self.guild_weeks.get(key)
+            if buckets is not None:
+                msgs |= buckets.since(week)
+        return msgs
+
+
+vote_index = VoteIndex()
+
+
+def active_channel_dates(guild_id, today=None):
+    # 保持期間内の (channel_id, message_id, date_str) をチャンネル・日付順に返す。
+    # そのサーバー (+ サーバー未記録の古いデータ) に絞る
+    today = today or today_jst()
+    rows = []
+    for msg_id in vote_index.guild_messages_since(guild_id, archive_week_key(retention_cutoff(today))):
+        entry = vote_data[msg_id]
+        rows.extend((entry.get("channel"), msg_id, d) for d in entry_dates(entry) if is_active_date(d, today))
+    rows.sort(key=lambda r: (r[0] or 0, r[2]))
+    return rows
+
+
+def target_week_rows(rows, weeks_ahead):
+    # active_channel_dates の結果を weeks_ahead 週後 (日曜始まり) の日程だけに絞る。None なら絞らない
+    if weeks_ahead is None:
+        return rows
+    start = get_schedule_start(weeks_ahead).date()
+    end = start + datetime.timedelta(weeks=1)
+    return [r for r in rows if (d := parse_vote_date(r[2])) is not None and start <= d < end]
+
+
+# 初期ロード
+load_votes()
+load_locations()
+load_confirmed()
+
+# -----------------------------
+# 出欠集計 (ロールアップ)
+# ユーザー × 曜日 × 級 × ISO週 の件数を array で持ち、投票・確定/不開催のたびに差分だけ足し引きする。
+# /stats は直近 N 週の配列を足すだけなので、履歴の長さに関係なく同じ速さで答えられる。
+# data/rollups.json にはアーカイブ済みの分だけを保存し、起動時にホットデータ分を足して復元する。
+# 作り直し: python bot.py rollups rebuild / 確認: python bot.py rollups show [週数]
 # -----------------------------
+ROLLUP_FILE = os.path.join(DATA_DIR, "rollups.json")
+ROLLUP_VERSION = 1
+UNKNOWN_LEVEL = "未特定"
+ROLLUP_LEVELS = LEVELS + (UNKNOWN_LEVEL,)
+OUTCOMES = ("確定", "不開催")
+WEEKDAY_JP = "月火水木金土日"
+ROLLUP_MAX_WEEKS = 520   # /stats でさかのぼれる週数の上限 (約 10 年)
+
+
+def level_from_channel_name(name):
+    for level in LEVELS:
+        if level in name:
+            return level
+    return UNKNOWN_LEVEL
+
+
+class AttendanceRollup:
+    # 1 週分の配列の並び: [曜日][級][ステータス] (outcomes は [曜日][級][確定/不開催])
+    VOTE_WIDTH = 7 * len(ROLLUP_LEVELS) * len(STATUSES)
+    OUTCOME_WIDTH = 7 * len(ROLLUP_LEVELS) * len(OUTCOMES)
+
+    def __init__(self):
+        self.user_weeks = {}   # user_id -> {週: array}
+        self.weeks = {}        # 週 -> array (全員の合計)
+        self.outcomes = {}     # 週 -> array
+        self.week_keys = []    # 出てきた週の昇順
+        self.archived = set()  # 数えたアーカイブ済みの message_id (base だけが使う)
+
+    def _cell(self, date_str, level):
+        d = parse_vote_date(date_str)
+        if d is None:
+            return None, 0
+        li = ROLLUP_LEVELS.index(level) if level in LEVELS else len(LEVELS)
+        return archive_week_key(d), d.weekday() * len(ROLLUP_LEVELS) + li
+
+    def _row(self, table, week, width):
+        row = table.get(week)
+        if row is None:
+            row = table[week] = array.array("i", [0]) * width
+            i = bisect.bisect_left(self.week_keys, week)
+            if i == len(self.week_keys) or self.week_keys[i] != week:
+                self.week_keys.insert(i, week)
+        return row
+
+    def add_vote(self, user_id, date_str, level, status, n=1):
+        week, cell = self._cell(date_str, level)
+        if week is None or status is None:
+            return
+        i = cell * len(STATUSES) + status
+        self._row(self.user_weeks.setdefault(user_id, {}), week, self.VOTE_WIDTH)[i] += n
+        self._row(self.weeks, week, self.VOTE_WIDTH)[i] += n
+
+    def change_vote(self, user_id, date_str, level, old, new):
+        if old == new:
+            return
+        self.add_vote(user_id, date_str, level, old, -1)
+        self.add_vote(user_id, date_str, level, new, 1)
+
+    def add_outcome(self, date_str, level, final, n=1):
+        week, cell = self._cell(date_str, level)
+        if week is None or final not in OUTCOMES:
+            return
+        self._row(self.outcomes, week, self.OUTCOME_WIDTH)[cell * len(OUTCOMES) + OUTCOMES.index(final)] += n
+
+    def change_outcome(self, date_str, level, old, new):
+        if old == new:
+            return
+        self.add_outcome(date_str, level, old, -1)
+        self.add_outcome(date_str, level, new, 1)
+
+    def add_entry(self, entry, n=1):
+        # vote_data の 1 エントリ分 (level の無い古いエントリは未特定として数える)
+        level = entry.get("level")
+        for date_str in entry_dates(entry):
+            for uid, code in entry[date_str].users.items():
+                self.add_vote(uid, date_str, level, code, n)
+
+    def add_confirmed(self, key, info, n=1):
+        _, _, date_str = key.partition("|")
+        self.add_outcome(date_str, info.get("level"), info.get("final"), n)
+
+    def merge(self, other):
+        for user_id, weeks in other.user_weeks.items():
+            for week, row in weeks.items():
+                self._add_row(self.user_weeks.setdefault(user_id, {}), week, row, self.VOTE_WIDTH)
+        for week, row in other.weeks.items():
+            self._add_row(self.weeks, week, row, self.VOTE_WIDTH)
+        for week, row in other.outcomes.items():
+            self._add_row(self.outcomes, week, row, self.OUTCOME_WIDTH)
+
+    def _add_row(self, table, week, row, width):
+        dst = self._row(table, week, width)
+        for i, v in enumerate(row):
+            if v:
+                dst[i] += v
+
+    def recent_weeks(self, n, today=None):
+        # today の週までの暦の上の直近 n 週 (記録の無い週も数え、先の週は含めない)。古い順
+        today = today or today_jst()
+        n = min(n, ROLLUP_MAX_WEEKS)
+        return [archive_week_key(today - datetime.timedelta(weeks=i)) for i in reversed(range(n))]
+
+    def sum_rows(self, table, weeks, width):
+        total = [0] * width
+        for week in weeks:
+            row = table.get(week)
+            if row is not None:
+                total = [a + b for a, b in zip(total, row)]
+        return total
+
+    def user_summary(self, user_id, weeks):
+        # -> {級: {曜日: [参加, オンライン可, 不可]}} (0 件の曜日は省く)
+        return self._by_level(self.sum_rows(self.user_weeks.get(user_id, {}), weeks, self.VOTE_WIDTH), len(STATUSES))
+
+    def level_summary(self, weeks):
+        # -> ({級: {曜日: [参加, オンライン可, 不可]}}, {級: {曜日: [確定, 不開催]}})
+        return (self._by_level(self.sum_rows(self.weeks, weeks, self.VOTE_WIDTH), len(STATUSES)),
+                self._by_level(self.sum_rows(self.outcomes, weeks, self.OUTCOME_WIDTH), len(OUTCOMES)))
+
+    def _by_level(self, total, width):
+        result = {}
+        for day in range(7):
+            for li, level in enumerate(ROLLUP_LEVELS):
+                start = (day * len(ROLLUP_LEVELS) + li) * width
+                counts = total[start:start + width]
+                if any(counts):
+                    result.setdefault(level, {})[WEEKDAY_JP[day]] = counts
+        return result
+
+    def to_json(self):
+        return {
+            "version": ROLLUP_VERSION,
+            "levels": list(ROLLUP_LEVELS),
+            "user_weeks": self.user_weeks,
+            "weeks": self.weeks,
+            "outcomes": self.outcomes,
+            "archived": sorted(self.archived),
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        # 版や級の並びが違えば None (呼び出し側で作り直す)
+        if data.get("version") != ROLLUP_VERSION or data.get("levels") != list(ROLLUP_LEVELS):
+            return None
+        rollup = cls()
+        for user_id, weeks in data.get("user_weeks", {}).items():
+            rollup.user_weeks[user_id] = {w: array.array("i", row) for w, row in weeks.items()}
+        rollup.weeks = {w: array.array("i", row) for w, row in data.get("weeks", {}).items()}
+        rollup.outcomes = {w: array.array("i", row) for w, row in data.get("outcomes", {}).items()}
+        rollup.week_keys = sorted(set(rollup.weeks) | set(rollup.outcomes))
+        rollup.archived = set(data.get("archived", ()))
+        return rollup
+
+
+attendance_base = AttendanceRollup()   # アーカイブ済みの分 (rollups.json)
+attendance = AttendanceRollup()        # base + ホットデータ (常に最新)
+
+
+def save_rollup_base():
+    try:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        write_json_atomic(ROLLUP_FILE, dump_json(attendance_base.to_json(), indent=None))
+    except Exception as e:
+        print(f"⚠ 集計の保存に失敗しました: {e}")
+
+
+def rebuild_archived_rollups():
+    # アーカイブを全部読み直して rollups.json を作り直す (同じメッセージが重複して書かれていても 1 回だけ数える)
+    global attendance_base
+    base = AttendanceRollup()
+    for week in archive_weeks():
+        for rec in read_archive(week):
+            if rec["message_id"] in base.archived:
+                continue
+            base.archived.add(rec["message_id"])
+            base.add_entry(decode_vote_entry(rec["entry"], {}))
+            for key, info in rec.get("confirmed", {}).items():
+                base.add_confirmed(key, info)
+    attendance_base = base
+    save_rollup_base()
+    return base
+
+
+def rebuild_live_rollups():
+    global attendance
+    live = AttendanceRollup()
+    live.merge(attendance_base)
+    # base に移した後、ホットデータから外す前に落ちた分は base 側で数えてある
+    for msg_id, entry in vote_data.items():
+        if msg_id not in attendance_base.archived:
+            live.add_entry(entry)
+    for key, info in confirmed.items():
+        if key.split("|", 1)[0] not in attendance_base.archived:
+            live.add_confirmed(key, info)
+    attendance = live
+    return live
+
+
+def load_rollups():
+    global attendance_base
+    base = None
+    try:
+        with open(ROLLUP_FILE, "r", encoding="utf-8") as f:
+            base = AttendanceRollup.from_json(json.load(f))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"⚠ 集計ファイルを読めませんでした: {e}")
+    if base is None:
+        base = rebuild_archived_rollups() if archive_weeks() else AttendanceRollup()
+    attendance_base = base
+    return rebuild_live_rollups()
+
+
+def format_rollup(summary, labels):
+    lines = []
+    for level in ROLLUP_LEVELS:
+        days = summary.get(level)
+        if not days:
+            continue
+        lines.append(f"**{level}**")
+        for day, counts in days.items():
+            lines.append(f"　{day}: " + " / ".join(f"{label} {c}" for label, c in zip(labels, counts)))
+    return lines
+
+
+def rollups_cli(argv):
+    if argv and argv[0] == "rebuild":
+        t0 = time.perf_counter()
+        rebuild_archived_rollups()
+        live = rebuild_live_rollups()
+        print(f"✅ 集計を作り直しました: {len(live.week_keys)} 週 / {len(live.user_weeks)} 人 ({time.perf_counter() - t0:.2f}s)")
+    elif argv and argv[0] == "show":
+        weeks = attendance.recent_weeks(int(argv[1]) if len(argv) >= 2 else 8)
+        votes, outcomes = attendance.level_summary(weeks)
+        print(f"{weeks[0]}〜{weeks[-1]}" if weeks else "まだ記録がありません。")
+        print("\n".join(format_rollup(votes, STATUSES) + format_rollup(outcomes, OUTCOMES)))
+    else:
+        print("使い方: python bot.py rollups rebuild | python bot.py rollups show [週数]")
+
+
+load_rollups()
+
+# -----------------------------
+# サーバー内の名前索引
+# ロール・カテゴリ・テキストチャンネルを名前 -> オブジェクトで引けるようにする。
+# 作成/更新/削除イベントで同期し、索引に無い名前は従来どおり走査する。
+# -----------------------------
+DIRECTORY_KINDS = ("roles", "categories", "text_channels")
+
+
+class GuildDirectory:
+    def __init__(self):
+        self.guilds = {}      # guild_id -> {kind: {name: obj}}
+        self.hits = 0
+        self.misses = 0
+
+    def _index(self, guild):
+        idx = self.guilds.get(guild.id)
+        if idx is None:
+            idx = self.guilds[guild.id] = {}
+            for kind in DIRECTORY_KINDS:
+                names = idx[kind] = {}
+                # 同名があれば先頭を使う (discord.utils.get と同じ)
+                for obj in getattr(guild, kind):
+                    names.setdefault(obj.name, obj)
+        return idx
+
+    def get(self, guild, kind, name):
+        if not guild:
+            return None
+        names = self._index(guild)[kind]
+        obj = names.get(name)
+        if obj is not None and obj.name == name:
+            self.hits += 1
+            return obj
+        self.misses += 1
+        obj = discord.utils.get(getattr(guild, kind), name=name)
+        if obj is not None:
+            names[name] = obj
+        else:
+            names.pop(name, None)
+        return obj
+
+    def add(self, guild, kind, obj):
+        idx = self.guilds.get(guild.id)
+        if idx is not None:
+            idx[kind].setdefault(obj.name, obj)
+
+    def remove(self, guild, kind, obj, name=None):
+        idx = self.guilds.get(guild.id)
+        if idx is None:
+            return
+        name = obj.name if name is None else name
+        names = idx[kind]
+        if names.get(name) is obj:
+            del names[name]
+            # 同名の別オブジェクトが残っていれば差し替える
+            other = discord.utils.get(getattr(guild, kind), name=name)
+            if other is not None and other is not obj:
+                names[name] = other
+
+    def drop_guild(self, guild):
+        self.guilds.pop(guild.id, None)
+
+    def stats(self):
+        return {"guilds": len(self.guilds), "hits": self.hits, "misses": self.misses}
+
+
+guild_directory = GuildDirectory()
+
+
+def channel_kind(channel):
+    if isinstance(channel, discord.CategoryChannel):
+        return "categories"
+    if isinstance(channel, discord.TextChannel):
+        return "text_channels"
+    return None
+
+
+@bot.listen("on_guild_role_create")
+async def _directory_on_role_create(role):
+    guild_directory.add(role.guild, "roles", role)
+
+
+@bot.listen("on_guild_role_delete")
+async def _directory_on_role_delete(role):
+    guild_directory.remove(role.guild, "roles", role)
+
+
+@bot.listen("on_guild_role_update")
+async def _directory_on_role_update(before, after):
+    if before.name != after.name:
+        guild_directory.remove(after.guild, "roles", after, name=before.name)
+        guild_directory.add(after.guild, "roles", after)
+
+
+@bot.listen("on_guild_channel_create")
+async def _directory_on_channel_create(channel):
+    kind = channel_kind(channel)
+    if kind:
+        guild_directory.add(channel.guild, kind, channel)
+
+
+@bot.listen("on_guild_channel_delete")
+async def _directory_on_channel_delete(channel):
+    kind = channel_kind(channel)
+    if kind:
+        guild_directory.remove(channel.guild, kind, channel)
+
+
+@bot.listen("on_guild_channel_update")
+async def _directory_on_channel_update(before, after):
+    kind = channel_kind(after)
+    if kind and before.name != after.name:
+        guild_directory.remove(after.guild, kind, after, name=before.name)
+        guild_directory.add(after.guild, kind, after)
+
+
+@bot.listen("on_guild_remove")
+async def _directory_on_guild_remove(guild):
+    guild_directory.drop_guild(guild)
+
 
 def role_by_name(guild, name):
-    if not guild: return None
-    return discord.utils.get(guild.roles, name=name)
+    return guild_directory.get(guild, "roles", name)
+
+
+def category_by_name(guild, name):
+    return guild_directory.get(guild, "categories", name)
+
+
+def text_channel_by_name(guild, name):
+    return guild_directory.get(guild, "text_channels", name)
 
 
 def has_admin_privilege(member: discord.Member):
@@ -140,6 +2009,624 @@ def has_admin_privilege(member: discord.Member):
         return True
     return False
 
+# -----------------------------
+# 投票対象メンバーのキャッシュ
+# チャンネルごとに「bot でも 講師/管理者 でもなく、チャンネルを閲覧できる」メンバー ID を持つ。
+# メンバーのロール変更・参加・退出は差分で反映し、チャンネル権限やロールが変わったら破棄する。
+# -----------------------------
+EXCLUDE_ROLE_NAMES = {"講師", "管理者"}
+
+
+class EligibleVoterCache:
+    def __init__(self):
+        self.channels = {}    # channel_id -> {str(member_id)}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def is_eligible(ch, member):
+        if member.bot:
+            return False
+        if any(r.name in EXCLUDE_ROLE_NAMES for r in member.roles):
+            return False
+        return ch.permissions_for(member).read_messages
+
+    def get(self, ch):
+        ids = self.channels.get(ch.id)
+        if ids is None:
+            self.misses += 1
+            ids = self.channels[ch.id] = {str(m.id) for m in ch.guild.members if self.is_eligible(ch, m)}
+        else:
+            self.hits += 1
+        return ids
+
+    def update_member(self, member):
+        for ch_id, ids in self.channels.items():
+            ch = member.guild.get_channel(ch_id)
+            if ch is None:
+                continue
+            if self.is_eligible(ch, member):
+                ids.add(str(member.id))
+            else:
+                ids.discard(str(member.id))
+
+    def remove_member(self, member):
+        for ids in self.channels.values():
+            ids.discard(str(member.id))
+
+    def invalidate_channel(self, channel_id):
+        self.channels.pop(channel_id, None)
+
+    def invalidate_guild(self, guild):
+        for ch in guild.channels:
+            self.channels.pop(ch.id, None)
+
+    def stats(self):
+        return {"channels": len(self.channels), "hits": self.hits, "misses": self.misses}
+
+
+eligible_voters = EligibleVoterCache()
+
+
+@bot.listen("on_member_update")
+async def _eligible_on_member_update(before, after):
+    if before.roles != after.roles:
+        eligible_voters.update_member(after)
+
+
+@bot.listen("on_member_update")
+async def _user_names_on_member_update(before, after):
+    # 投票したことのあるメンバーだけ表示名を追従する
+    user_id = str(after.id)
+    if before.display_name != after.display_name and user_id in user_names:
+        remember_user(user_id, after.display_name)
+
+
+@bot.listen("on_member_join")
+async def _eligible_on_member_join(member):
+    eligible_voters.update_member(member)
+
+
+@bot.listen("on_member_remove")
+async def _eligible_on_member_remove(member):
+    eligible_voters.remove_member(member)
+
+
+@bot.listen("on_guild_channel_update")
+async def _eligible_on_channel_update(before, after):
+    if before.overwrites != after.overwrites or before.category_id != after.category_id:
+        eligible_voters.invalidate_channel(after.id)
+
+
+@bot.listen("on_guild_channel_delete")
+async def _eligible_on_channel_delete(channel):
+    eligible_voters.invalidate_channel(channel.id)
+
+
+@bot.listen("on_guild_role_update")
+async def _eligible_on_role_update(before, after):
+    if before.permissions != after.permissions or before.name != after.name:
+        eligible_voters.invalidate_guild(after.guild)
+
+
+@bot.listen("on_guild_role_delete")
+async def _eligible_on_role_delete(role):
+    eligible_voters.invalidate_guild(role.guild)
+
+# -----------------------------
+# 送信キュー
+# bot からの送信・編集はすべてここを通す。
+# - ルート (チャンネル / interaction / ギルド) ごとに 1 本のワーカーで順番に送り、別ルートは並行して送る
+# - チャンネルごとのバケット (OUTBOUND_ROUTE_RATE 件 / OUTBOUND_ROUTE_PER 秒) と全体のバケットで送信間隔を調整する
+# - 優先度: interaction 応答 > 人数確定通知 > 投票 Embed 更新 > 一括投稿 (Step1~3)
+#   一括投稿は全体バケットの残りが OUTBOUND_BULK_RESERVE 以下なら待つので、通知や応答の分が常に残る
+# -----------------------------
+OUTBOUND_ROUTE_RATE = int(os.getenv("OUTBOUND_ROUTE_RATE", "5"))
+OUTBOUND_ROUTE_PER = float(os.getenv("OUTBOUND_ROUTE_PER", "5"))
+OUTBOUND_GLOBAL_RATE = int(os.getenv("OUTBOUND_GLOBAL_RATE", "40"))
+OUTBOUND_BULK_RESERVE = int(os.getenv("OUTBOUND_BULK_RESERVE", "10"))
+
+PRIO_INTERACTION = 0
+PRIO_NOTICE = 1
+PRIO_RENDER = 2
+PRIO_BULK = 5
+PRIORITY_NAMES = {PRIO_INTERACTION: "interaction", PRIO_NOTICE: "notice", PRIO_RENDER: "render", PRIO_BULK: "bulk"}
+
+
+class TokenBucket:
+    def __init__(self, rate, per):
+        self.capacity = rate
+        self.tokens = float(rate)
+        self.per = per
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / self.per)
+        self.updated = now
+
+    def take(self, reserve=0):
+        # トークンを 1 つ使う。足りなければ待つべき秒数を返す (その場合は使わない)
+        self._refill()
+        if self.tokens >= 1 + reserve:
+            self.tokens -= 1
+            return 0.0
+        return (1 + reserve - self.tokens) * self.per / self.capacity
+
+
+class OutboundQueue:
+    def __init__(self):
+        self.queues = {}      # route -> heap[(priority, seq, enqueued_at, factory, future)]
+        self.workers = {}     # route -> task
+        self.buckets = {}     # route -> TokenBucket
+        self.global_bucket = TokenBucket(OUTBOUND_GLOBAL_RATE, 1.0)
+        self.seq = itertools.count()
+        self.depth = 0
+        self.max_depth = 0
+        self.completed = 0
+        self.failed = 0
+        self.waits = {}       # priority -> [件数, 合計待ち秒, 最大待ち秒]
+
+    async def call(self, route, priority, factory):
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        heapq.heappush(self.queues.setdefault(route, []), (priority, next(self.seq), loop.time(), factory, fut))
+        self.depth += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        if route not in self.workers:
+            self.workers[route] = loop.create_task(self._worker(route))
+        return await fut
+
+    async def _acquire(self, route, priority):
+        # interaction 応答は interaction ごとのエンドポイントなのでバケットを使わない
+        if priority == PRIO_INTERACTION:
+            return
+        if route.startswith("ch:"):
+            bucket = self.buckets.get(route)
+            if bucket is None:
+                bucket = self.buckets[route] = TokenBucket(OUTBOUND_ROUTE_RATE, OUTBOUND_ROUTE_PER)
+            while (delay := bucket.take()) > 0:
+                await asyncio.sleep(delay)
+        reserve = OUTBOUND_BULK_RESERVE if priority >= PRIO_BULK else 0
+        while (delay := self.global_bucket.take(reserve)) > 0:
+            await asyncio.sleep(delay)
+
+    async def _worker(self, route):
+        heap = self.queues[route]
+        loop = asyncio.get_running_loop()
+        try:
+            while heap:
+                priority, _, enqueued_at, factory, fut = heapq.heappop(heap)
+                self.depth -= 1
+                if fut.done():
+                    continue
+                await self._acquire(route, priority)
+                wait = loop.time() - enqueued_at
+                w = self.waits.setdefault(priority, [0, 0.0, 0.0])
+                w[0] += 1
+                w[1] += wait
+                w[2] = max(w[2], wait)
+                labels = {"route": route.split(":", 1)[0], "priority": PRIORITY_NAMES.get(priority, str(priority))}
+                metrics.observe("outbound_queue_wait_seconds", wait, priority=labels["priority"])
+                t0 = time.perf_counter()
+                try:
+                    result = await factory()
+                except Exception as e:
+                    self.failed += 1
+                    metrics.inc("discord_api_calls", result="error", **labels)
+                    if not fut.done():
+                        fut.set_exception(e)
+                else:
+                    self.completed += 1
+                    metrics.inc("discord_api_calls", result="ok", **labels)
+                    if not fut.done():
+                        fut.set_result(result)
+                finally:
+                    metrics.observe("discord_api_seconds", time.perf_counter() - t0, **labels)
+        finally:
+            del self.workers[route]
+            if not heap:
+                del self.queues[route]
+
+    def stats(self):
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "routes": len(self.workers),
+            "completed": self.completed,
+            "failed": self.failed,
+            "wait": {
+                PRIORITY_NAMES.get(p, str(p)): {"count": n, "avg_ms": total / n * 1000 if n else 0.0, "max_ms": mx * 1000}
+                for p, (n, total, mx) in sorted(self.waits.items())
+            },
+        }
+
+
+outbound = OutboundQueue()
+
+
+def api(route, priority, factory):
+    return outbound.call(route, priority, factory)
+
+
+def reply(interaction, *args, **kwargs):
+    return outbound.call(f"ix:{interaction.id}", PRIO_INTERACTION, lambda: interaction.response.send_message(*args, **kwargs))
+
+
+def followup(interaction, *args, **kwargs):
+    return outbound.call(f"ix:{interaction.id}", PRIO_INTERACTION, lambda: interaction.followup.send(*args, **kwargs))
+
+
+def channel_send(ch, priority, *args, **kwargs):
+    return outbound.call(f"ch:{ch.id}", priority, lambda: ch.send(*args, **kwargs))
+
+
+async def gather_sends(sends):
+    # 一括送信: 別チャンネルは並行、同じチャンネルは投入順。失敗件数を返す
+    results = await asyncio.gather(*sends, return_exceptions=True)
+    failures = [r for r in results if isinstance(r, Exception)]
+    for e in failures[:3]:
+        print(f"⚠ 送信エラー: {e}")
+    return len(failures)
+
+# -----------------------------
+# メッセージごとの直列化 (actor)
+# 同じ投票メッセージへの変更と Embed 編集は message_id ごとのキューで 1 件ずつ順番に処理する。
+# 別メッセージのキューは互いに待たないので並行に進む。キューが空になったら worker は終了する。
+# -----------------------------
+class MessageActors:
+    def __init__(self):
+        self.queues = {}      # message_id -> deque[(job, future)]
+        self.workers = {}     # message_id -> task
+        self.jobs = 0
+        self.max_backlog = 0
+
+    async def run(self, key, job):
+        # job (引数なしの async 関数) を key のキューの最後に積み、その結果を返す
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        queue = self.queues.setdefault(key, collections.deque())
+        queue.append((job, fut))
+        self.max_backlog = max(self.max_backlog, len(queue))
+        if key not in self.workers:
+            self.workers[key] = loop.create_task(self._worker(key))
+        return await fut
+
+    def backlog(self, key):
+        # key のキューで順番を待っている件数 (実行中の分は含まない)
+        return len(self.queues.get(key, ()))
+
+    async def _worker(self, key):
+        queue = self.queues[key]
+        try:
+            while queue:
+                job, fut = queue.popleft()
+                if fut.done():
+                    continue
+                self.jobs += 1
+                try:
+                    result = await job()
+                except Exception as e:
+                    if not fut.done():
+                        fut.set_exception(e)
+                else:
+                    if not fut.done():
+                        fut.set_result(result)
+        finally:
+            del self.workers[key]
+            if not queue:
+                del self.queues[key]
+
+    def stats(self):
+        return {"active": len(self.workers), "jobs": self.jobs, "max_backlog": self.max_backlog}
+
+
+message_actors = MessageActors()
+
+# -----------------------------
+# メッセージ待ち (画像アップロード待ちなど)
+# bot.wait_for は待っている人数分のチェック関数が全メッセージで呼ばれるので、
+# (channel_id, user_id) -> Future の dict を on_message で 1 回引くだけにする。
+# タイムアウトは 1 本のタイマーホイール (WAITER_TICK_SEC 刻み) でまとめて処理する。
+# -----------------------------
+WAITER_TIMEOUT_SEC = int(os.getenv("WAITER_TIMEOUT_SEC", "300"))
+WAITER_TICK_SEC = float(os.getenv("WAITER_TICK_SEC", "1"))
+
+
+class WaiterCancelled(Exception):
+    pass
+
+
+class TimerWheel:
+    def __init__(self, tick=WAITER_TICK_SEC, slots=64):
+        self.tick = tick
+        self.wheel = [{} for _ in range(slots)]   # slot -> {key: [残り周回数, callback]}
+        self.where = {}       # key -> slot
+        self.cursor = 0
+        self.task = None
+
+    def schedule(self, key, delay, callback):
+        # delay 秒後 (tick 単位で切り上げ) に callback() を呼ぶ。同じ key の予定は置き換える
+        self.cancel(key)
+        ticks = max(1, math.ceil(delay / self.tick))
+        slot = (self.cursor + ticks) % len(self.wheel)
+        self.wheel[slot][key] = [(ticks - 1) // len(self.wheel), callback]
+        self.where[key] = slot
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    def cancel(self, key):
+        slot = self.where.pop(key, None)
+        if slot is None:
+            return False
+        del self.wheel[slot][key]
+        return True
+
+    async def _run(self):
+        # 予定がある間だけ回る
+        try:
+            while self.where:
+                await asyncio.sleep(self.tick)
+                self.cursor = (self.cursor + 1) % len(self.wheel)
+                bucket = self.wheel[self.cursor]
+                for key, entry in list(bucket.items()):
+                    if entry[0]:
+                        entry[0] -= 1
+                        continue
+                    del bucket[key]
+                    del self.where[key]
+                    try:
+                        entry[1]()
+                    except Exception as e:
+                        print(f"⚠ タイマー処理エラー {key}: {e}")
+        finally:
+            self.task = None
+
+
+class WaiterRegistry:
+    def __init__(self):
+        self.waiters = {}     # (channel_id, user_id) -> Future
+        self.wheel = TimerWheel()
+        self.registered = 0
+        self.matched = 0
+        self.timed_out = 0
+        self.cancelled = 0
+        self.messages = 0     # on_message で照合したメッセージ数
+
+    async def wait(self, channel_id, user_id, timeout=WAITER_TIMEOUT_SEC):
+        # channel_id で user_id が次に送ったメッセージを返す。
+        # タイムアウトは asyncio.TimeoutError、取り消し (同じ人の新しい待ちを含む) は WaiterCancelled
+        key = (channel_id, user_id)
+        self.cancel(channel_id, user_id)
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters[key] = fut
+        self.registered += 1
+        self.wheel.schedule(key, timeout, lambda: self._expire(key, fut))
+        try:
+            return await fut
+        finally:
+            if self.waiters.get(key) is fut:
+                del self.waiters[key]
+                self.wheel.cancel(key)
+
+    def _expire(self, key, fut):
+        if self.waiters.get(key) is fut:
+            del self.waiters[key]
+            self.timed_out += 1
+            if not fut.done():
+                fut.set_exception(asyncio.TimeoutError())
+
+    def dispatch(self, message):
+        self.messages += 1
+        key = (message.channel.id, message.author.id)
+        fut = self.waiters.pop(key, None)
+        if fut is None:
+            return False
+        self.wheel.cancel(key)
+        if fut.done():
+            return False
+        self.matched += 1
+        fut.set_result(message)
+        return True
+
+    def cancel(self, channel_id, user_id):
+        key = (channel_id, user_id)
+        fut = self.waiters.pop(key, None)
+        if fut is None:
+            return False
+        self.wheel.cancel(key)
+        if not fut.done():
+            self.cancelled += 1
+            fut.set_exception(WaiterCancelled())
+        return True
+
+    def cancel_channel(self, channel_id):
+        for key in [k for k in self.waiters if k[0] == channel_id]:
+            self.cancel(*key)
+
+    def stats(self):
+        return {
+            "active": len(self.waiters),
+            "registered": self.registered,
+            "matched": self.matched,
+            "timed_out": self.timed_out,
+            "cancelled": self.cancelled,
+            "messages": self.messages,
+        }
+
+
+message_waiters = WaiterRegistry()
+
+
+@bot.listen("on_message")
+async def _waiters_on_message(message):
+    if message_waiters.waiters and message_waiters.dispatch(message) and tracer.path:
+        tracer.upload(message)
+
+
+@bot.listen("on_guild_channel_delete")
+async def _waiters_on_channel_delete(channel):
+    message_waiters.cancel_channel(channel.id)
+
+# -----------------------------
+# 操作の記録 (負荷試験用トレース)
+# TRACE_FILE を指定した時だけ、受け取った操作 (投票ボタン・開催する/しない・スタジオ選択・
+# 画像待ちへの返信・スラッシュコマンド) を 1 行 1 件の NDJSON で追記する。
+# ユーザー・チャンネル・メッセージの ID は TRACE_SALT 付きのハッシュに置き換える
+# (TRACE_SALT 未指定なら起動ごとにランダムなので、別の起動のトレース同士では対応が取れない)。
+# 再生: python bench.py replay <trace.ndjson> --speed 1 10 100
+# -----------------------------
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+TRACE_SALT = os.getenv("TRACE_SALT") or os.urandom(16).hex()
+# ID がそのまま入るオプションの型 (user / channel / role / mentionable)
+TRACE_ID_OPTION_TYPES = (6, 7, 8, 9)
+
+
+class TraceRecorder:
+    def __init__(self, path, salt):
+        self.path = path
+        self.key = hashlib.sha256(salt.encode()).digest()
+        self.fp = None
+        self.events = 0
+
+    def anon(self, value):
+        if value is None:
+            return None
+        return hashlib.blake2b(str(value).encode(), key=self.key, digest_size=8).hexdigest()
+
+    def record(self, kind, **fields):
+        if not self.path:
+            return
+        if self.fp is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.fp = open(self.path, "a", encoding="utf-8")
+        event = {"t": round(time.time(), 4), "kind": kind, **fields}
+        self.fp.write(json.dumps(event, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self.fp.flush()
+        self.events += 1
+
+    def notice_fields(self, notice_key):
+        # 人数確定通知のキー "message_id|date" -> 元の投票メッセージ (匿名) と日程
+        msg_id, _, date_str = notice_key.partition("|")
+        return {"message": self.anon(msg_id), "date": date_str, "level": confirmed.get(notice_key, {}).get("level")}
+
+    def interaction(self, interaction):
+        data = interaction.data or {}
+        base = {"user": self.anon(interaction.user.id), "channel": self.anon(interaction.channel_id)}
+        if interaction.type == discord.InteractionType.application_command:
+            # ID の入るオプション (メンバー指定など) は匿名化して ids に分ける
+            options = {o["name"]: o.get("value") for o in data.get("options", []) if o.get("type") not in TRACE_ID_OPTION_TYPES}
+            ids = {o["name"]: self.anon(o.get("value")) for o in data.get("options", []) if o.get("type") in TRACE_ID_OPTION_TYPES}
+            self.record("command", name=data.get("name"), options=options, ids=ids, **base)
+            return
+        if interaction.type != discord.InteractionType.component:
+            return
+        kind, _, rest = data.get("custom_id", "").partition(":")
+        if kind == "vote":
+            status, _, date_str = rest.partition(":")
+            channel = interaction.channel
+            level = vote_index.channel_level(interaction.channel_id) or level_from_channel_name(getattr(channel, "name", "") or "")
+            self.record("vote", message=self.anon(interaction.message.id if interaction.message else None),
+                        date=date_str, level=level, status=("yes", "maybe", "no").index(status), **base)
+        elif kind == "confirm":
+            action, _, notice_key = rest.partition(":")
+            self.record("confirm" if action == "ok" else "cancel", **self.notice_fields(notice_key), **base)
+        elif kind == "studio":
+            self.record("studio", studio=(data.get("values") or [None])[0], **self.notice_fields(rest), **base)
+
+    def upload(self, message):
+        # 画像待ち (スタジオ選択の後) に届いた返信
+        self.record("upload", user=self.anon(message.author.id), channel=self.anon(message.channel.id),
+                    skip=(message.content or "").lower() == "skip", attachment=bool(message.attachments))
+
+
+tracer = TraceRecorder(TRACE_FILE, TRACE_SALT)
+
+
+@bot.listen("on_interaction")
+async def _trace_on_interaction(interaction):
+    if tracer.path:
+        try:
+            tracer.interaction(interaction)
+        except Exception as e:
+            print(f"⚠ トレースの記録に失敗しました: {e}")
+
+# -----------------------------
+# 投票 Embed の描画
+# VOTE_RENDER_MODE=immediate (既定: クリックごとに編集) / debounce
+# debounce: クリックには defer で即応答し、Embed の編集はメッセージごとに
+# VOTE_RENDER_WINDOW_MS に最大 1 回、その時点の最新状態で行う
+# -----------------------------
+VOTE_RENDER_MODE = os.getenv("VOTE_RENDER_MODE", "immediate")
+VOTE_RENDER_WINDOW_MS = int(os.getenv("VOTE_RENDER_WINDOW_MS", "1000"))
+
+
+def build_vote_embed(date_str, rec):
+    embed = discord.Embed(title=f"📅 予定候補: {date_str}")
+    for code, label in enumerate(STATUSES):
+        embed.add_field(name=f"{label} ({rec.counts[code]}人)", value="\n".join(rec.names(code)) if rec.counts[code] else "0人", inline=False)
+    return embed
+
+
+class VoteRenderScheduler:
+    def __init__(self, window_ms=VOTE_RENDER_WINDOW_MS):
+        self.window = window_ms / 1000
+        self.pending = {}     # message_id -> (date_str, interaction, view) 最新のクリック分だけ残す
+        self.last_sent = {}   # message_id -> 最後に編集した時刻 (loop.time())
+        self.tasks = {}       # message_id -> 描画 task (GC されないように参照を持つ)
+        self.requested = 0
+        self.sent = 0
+        self.failed = 0
+
+    def request(self, message_id, date_str, interaction, view):
+        self.requested += 1
+        scheduled = message_id in self.pending
+        self.pending[message_id] = (date_str, interaction, view)
+        if scheduled:
+            # 前のクリック分は描画せずに最新の状態へまとめる
+            metrics.inc("vote_render_skipped")
+            return
+        # 直近に編集していなければすぐ、していればウィンドウの終わりに描画する
+        loop = asyncio.get_running_loop()
+        delay = max(0.0, self.last_sent.get(message_id, float("-inf")) + self.window - loop.time())
+        loop.call_later(delay, self._start, message_id)
+
+    def _start(self, message_id):
+        task = asyncio.get_running_loop().create_task(message_actors.run(message_id, lambda: self._render(message_id)))
+        self.tasks[message_id] = task
+        task.add_done_callback(lambda t: self.tasks.get(message_id) is t and self.tasks.pop(message_id))
+
+    async def _render(self, message_id):
+        # message_actors 上で実行するので、前の描画が終わるまで次の描画は始まらない
+        date_str, interaction, view = self.pending.pop(message_id)
+        self.last_sent[message_id] = asyncio.get_running_loop().time()
+        rec = get_vote_record(message_id, date_str)
+        if rec is None:
+            metrics.inc("vote_render_skipped")
+            return
+        try:
+            # defer 済みの interaction の元メッセージ (= 投票メッセージ) を編集する
+            await api(f"ix:{interaction.id}", PRIO_RENDER,
+                      lambda: interaction.edit_original_response(embed=build_vote_embed(date_str, rec), view=view))
+            self.sent += 1
+            metrics.inc("vote_render_sent")
+        except Exception as e:
+            self.failed += 1
+            metrics.inc("vote_render_failed")
+            print(f"⚠ 投票 Embed の更新に失敗しました {message_id}: {e}")
+
+    def stats(self):
+        return {
+            "requested": self.requested,
+            "sent": self.sent,
+            "failed": self.failed,
+            "skipped": self.requested - self.sent - self.failed - len(self.pending),
+            "pending": len(self.pending),
+        }
+
+
+vote_renderer = VoteRenderScheduler()
+
 # -----------------------------
 # VoteView
 # -----------------------------
@@ -147,64 +2634,84 @@ class VoteView(discord.ui.View):
     def __init__(self, date_str):
         super().__init__(timeout=None)
         self.date_str = date_str
+        # 再起動後も同じボタンとして受け取れるよう custom_id に日程を入れる
+        self.yes_button.custom_id = f"vote:yes:{date_str}"
+        self.maybe_button.custom_id = f"vote:maybe:{date_str}"
+        self.no_button.custom_id = f"vote:no:{date_str}"
 
-    async def handle_vote(self, interaction: discord.Interaction, status: str):
+    @instrumented("vote")
+    async def handle_vote(self, interaction: discord.Interaction, status: int):
         message_id = str(interaction.message.id)
-        user_id = str(interaction.user.id)
-        user_name = interaction.user.display_name
+        # 同じメッセージへの変更と Embed 編集はクリックの到着順に 1 件ずつ (別メッセージは並行)
+        rendered, notice = await message_actors.run(message_id, lambda: self.apply_vote(interaction, message_id, status))
+        if rendered is None:
+            # アーカイブ済み・日程の過ぎた投票 (ボタンは再起動まで押せてしまう)
+            try:
+                await reply(interaction, "⚠️ この投票は締め切られました。", ephemeral=True)
+            except Exception:
+                pass
+            return
+        if not rendered:
+            # Embed は後ろに並んでいるクリック (または debounce の描画) が最新の状態で更新するので、応答だけ返す
+            try:
+                await api(f"ix:{interaction.id}", PRIO_INTERACTION, lambda: interaction.response.defer())
+            except Exception:
+                pass
+            if VOTE_RENDER_MODE == "debounce":
+                vote_renderer.request(message_id, self.date_str, interaction, self)
 
-        if message_id not in vote_data:
-            vote_data[message_id] = {}
-        if self.date_str not in vote_data[message_id]:
-            vote_data[message_id][self.date_str] = {"参加(🟢)": {}, "オンライン可(🟡)": {}, "不可(🔴)": {}}
+        # 自動通知: 参加1名以上で人数確定通知
+        if notice:
+            level, participants, key = notice
+            await send_confirm_notice(interaction.guild, level, self.date_str, participants, key, source_channel_id=interaction.channel.id)
+
+    async def apply_vote(self, interaction, message_id, status):
+        # message_actors 上で実行する。(Embed を編集したか, 人数確定通知の引数 or None) を返す。
+        # 記録の無い (アーカイブ済みなど) 投票・保持期間を過ぎた日程なら (None, None) を返して何も変えない
+        rec = get_vote_record(message_id, self.date_str)
+        if rec is None or not is_active_date(self.date_str):
+            return None, None
+        user_id = str(interaction.user.id)
+        remember_user(user_id, interaction.user.display_name)
 
         # トグル
-        current_status = None
-        for k, v in vote_data[message_id][self.date_str].items():
-            if user_id in v:
-                current_status = k
-                break
-        if current_status == status:
-            del vote_data[message_id][self.date_str][status][user_id]
-        else:
-            for v_dict in vote_data[message_id][self.date_str].values():
-                if user_id in v_dict:
-                    del v_dict[user_id]
-            vote_data[message_id][self.date_str][status][user_id] = user_name
+        old_status = rec.users.get(user_id)
+        new_status = rec.toggle(user_id, status)
+        record_vote(message_id, self.date_str, user_id, new_status)
+        attendance.change_vote(user_id, self.date_str, vote_data[message_id].get("level"), old_status, new_status)
 
-        save_votes()
-
-        # Embed更新
-        embed = discord.Embed(title=f"📅 予定候補: {self.date_str}")
-        for k, v in vote_data[message_id][self.date_str].items():
-            embed.add_field(name=f"{k} ({len(v)}人)", value="\n".join(v.values()) if v else "0人", inline=False)
+        notice = None
+        if rec.counts[YES] >= 1:
+            key = f"{message_id}|{self.date_str}"
+            load_confirmed()
+            if confirmed.get(key) is None:
+                participants = list(rec.names(YES))
+                confirmed[key] = {"notified": True, "participants": participants}
+                save_confirmed(key)
+                level = vote_index.channel_level(interaction.channel.id) or level_from_channel_name(interaction.channel.name)
+                notice = (level, participants, key)
+
+        # Embed更新: 後ろにクリックが並んでいれば最後の 1 件だけが編集する
+        if VOTE_RENDER_MODE == "debounce" or message_actors.backlog(message_id):
+            return False, notice
         try:
-            await interaction.response.edit_message(embed=embed, view=self)
+            await api(f"ix:{interaction.id}", PRIO_INTERACTION,
+                      lambda: interaction.response.edit_message(embed=build_vote_embed(self.date_str, rec), view=self))
         except Exception:
             pass
-
-        # 自動通知: 参加1名以上で人数確定通知
-        participants = vote_data[message_id][self.date_str]["参加(🟢)"]
-        if len(participants) >= 1:
-            key = f"{message_id}|{self.date_str}"
-            if confirmed.get(key) is None:
-                confirmed[key] = {"notified": True, "participants": list(participants.values())}
-                save_confirmed()
-                channel_name = interaction.channel.name
-                level = "初級" if "初級" in channel_name else ("中級" if "中級" in channel_name else "未特定")
-                await send_confirm_notice(interaction.guild, level, self.date_str, list(participants.values()), key, source_channel_id=interaction.channel.id)
+        return True, notice
 
     @discord.ui.button(label="参加(🟢)", style=discord.ButtonStyle.success)
     async def yes_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        await self.handle_vote(interaction, "参加(🟢)")
+        await self.handle_vote(interaction, YES)
 
     @discord.ui.button(label="オンライン可(🟡)", style=discord.ButtonStyle.primary)
     async def maybe_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        await self.handle_vote(interaction, "オンライン可(🟡)")
+        await self.handle_vote(interaction, MAYBE)
 
     @discord.ui.button(label="不可(🔴)", style=discord.ButtonStyle.danger)
     async def no_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        await self.handle_vote(interaction, "不可(🔴)")
+        await self.handle_vote(interaction, NO)
 
 # -----------------------------
 # ConfirmViewWithImage & Studio selection
@@ -215,44 +2722,55 @@ class ConfirmViewWithImage(discord.ui.View):
         self.level = level
         self.date_str = date_str
         self.notice_key = notice_key
+        if notice_key:
+            self.confirm_button.custom_id = f"confirm:ok:{notice_key}"
+            self.cancel_button.custom_id = f"confirm:ng:{notice_key}"
 
     @discord.ui.button(label="開催する", style=discord.ButtonStyle.success)
+    @instrumented("confirm")
     async def confirm_button(self, interaction: discord.Interaction, button: discord.ui.Button):
         # 講師権限チェック
         role = role_by_name(interaction.guild, "講師")
         if role and role not in interaction.user.roles:
-            await interaction.response.send_message("⚠️ この操作は講師のみ可能です。", ephemeral=True)
+            await reply(interaction, "⚠️ この操作は講師のみ可能です。", ephemeral=True)
             return
 
-        await interaction.response.send_message("🏷 /place に登録している場所から選んでください。", ephemeral=True)
+        await reply(interaction, "🏷 /place に登録している場所から選んでください。", ephemeral=True)
 
         # ロケーションが無ければ通知
-        locs = load_locations().get("共通", [])
+        load_locations()
+        locs = guild_locations(interaction.guild.id)
         if not locs:
-            await interaction.followup.send("⚠️ スタジオが未登録です。/place 登録 <名前> で追加してください。", ephemeral=True)
+            await followup(interaction, "⚠️ スタジオが未登録です。/place 登録 <名前> で追加してください。", ephemeral=True)
             return
 
         view = StudioSelectView(self.date_str, locs, self.notice_key)
-        await interaction.followup.send("🏢 スタジオを選択してください。", view=view, ephemeral=True)
+        await followup(interaction, "🏢 スタジオを選択してください。", view=view, ephemeral=True)
 
     @discord.ui.button(label="開催しない", style=discord.ButtonStyle.danger)
+    @instrumented("cancel")
     async def cancel_button(self, interaction: discord.Interaction, button: discord.ui.Button):
         # 講師権限チェック
         role = role_by_name(interaction.guild, "講師")
         if role and role not in interaction.user.roles:
-            await interaction.response.send_message("⚠️ この操作は講師のみ可能です。", ephemeral=True)
+            await reply(interaction, "⚠️ この操作は講師のみ可能です。", ephemeral=True)
             return
 
+        # 開催するを選んで画像待ちになっていれば取り消す (後から確定扱いにならないように)
+        message_waiters.cancel(interaction.channel.id, interaction.user.id)
+
         # 不開催処理: 元の投票チャンネルへ通知
         if self.notice_key:
+            load_confirmed()
             info = confirmed.setdefault(self.notice_key, {})
+            attendance.change_outcome(self.date_str, info.get("level"), info.get("final"), "不開催")
             info.update({"final": "不開催", "confirmed_by": interaction.user.display_name, "timestamp": datetime.datetime.now(JST).isoformat()})
-            save_confirmed()
+            save_confirmed(self.notice_key)
             src_channel_id = info.get("source_channel")
             ch = bot.get_channel(src_channel_id) if src_channel_id else None
             if ch:
-                await ch.send(f"❌ {self.date_str} は開催不可と講師が判断しました。")
-        await interaction.response.send_message("✅ 不開催を送信しました。", ephemeral=True)
+                await channel_send(ch, PRIO_NOTICE, f"❌ {self.date_str} は開催不可と講師が判断しました。")
+        await reply(interaction, "✅ 不開催を送信しました。", ephemeral=True)
 
 class StudioSelectView(discord.ui.View):
     def __init__(self, date_str, locations_list, notice_key=None):
@@ -267,17 +2785,18 @@ class StudioDropdown(discord.ui.Select):
         super().__init__(placeholder="スタジオを選択してください", options=options, min_values=1, max_values=1)
         self.date_str = date_str
         self.notice_key = notice_key
+        if notice_key:
+            # トレースでどの通知への選択か分かるように
+            self.custom_id = f"studio:{notice_key}"
 
+    @instrumented("studio_select")
     async def callback(self, interaction: discord.Interaction):
         studio = self.values[0]
         # 画像を送るように促す
-        await interaction.response.send_message("画像をこのチャンネルにアップロードしてください。無ければ `skip` と入力してください。", ephemeral=True)
-
-        def check(msg):
-            return msg.author == interaction.user and msg.channel == interaction.channel
+        await reply(interaction, "画像をこのチャンネルにアップロードしてください。無ければ `skip` と入力してください。", ephemeral=True)
 
         try:
-            msg = await bot.wait_for('message', check=check, timeout=300)
+            msg = await message_waiters.wait(interaction.channel.id, interaction.user.id)
             if msg.content.lower() == "skip":
                 image_url = None
             elif msg.attachments:
@@ -286,11 +2805,16 @@ class StudioDropdown(discord.ui.Select):
                 image_url = None
         except asyncio.TimeoutError:
             image_url = None
-            await interaction.followup.send("⏰ 画像送信タイムアウト。スキップ扱いにします。", ephemeral=True)
+            await followup(interaction, "⏰ 画像送信タイムアウト。スキップ扱いにします。", ephemeral=True)
+        except WaiterCancelled:
+            # スタジオを選び直した / 開催しないを押した
+            return
 
         # 確定情報保存
         if self.notice_key:
+            load_confirmed()
             info = confirmed.setdefault(self.notice_key, {})
+            attendance.change_outcome(self.date_str, info.get("level"), info.get("final"), "確定")
             info.update({
                 "final": "確定",
                 "studio": studio,
@@ -298,7 +2822,7 @@ class StudioDropdown(discord.ui.Select):
                 "confirmed_by": interaction.user.display_name,
                 "timestamp": datetime.datetime.now(JST).isoformat()
             })
-            save_confirmed()
+            save_confirmed(self.notice_key)
 
             # 元の投票チャンネルへ確定を送信
             src_channel_id = info.get("source_channel")
@@ -307,166 +2831,541 @@ class StudioDropdown(discord.ui.Select):
                 embed = discord.Embed(title="✅【開催確定】", description=f"{self.date_str} は **{studio}** で開催が確定しました。参加者の皆さん、よろしくお願いします！")
                 if image_url:
                     embed.set_image(url=image_url)
-                await ch.send(embed=embed)
+                await channel_send(ch, PRIO_NOTICE, embed=embed)
 
         try:
-            await interaction.followup.send(f"✅ {studio} を選択し、確定処理を完了しました。", ephemeral=True)
+            await followup(interaction, f"✅ {studio} を選択し、確定処理を完了しました。", ephemeral=True)
         except Exception:
             pass
 
 # -----------------------------
 # 確定通知 helper
 # -----------------------------
+@instrumented("confirm_notice")
 async def send_confirm_notice(guild: discord.Guild, level: str, date_str: str, participants: list, notice_key: str = None, source_channel_id: int = None):
     # 人数確定通知所チャネルを探す（無ければ作成）
-    confirm_channel = discord.utils.get(guild.text_channels, name="人数確定通知所")
+    confirm_channel = text_channel_by_name(guild, "人数確定通知所")
     if not confirm_channel:
         # 作成する場合はデフォルトカテゴリなしで作る
-        confirm_channel = await guild.create_text_channel("人数確定通知所")
+        confirm_channel = await api(f"guild:{guild.id}", PRIO_NOTICE, lambda: guild.create_text_channel("人数確定通知所"))
 
     role = role_by_name(guild, "講師")
     mention = role.mention if role else "@講師"
     participants_list = ", ".join(participants) if participants else "なし"
     if notice_key:
+        load_confirmed()
         confirmed.setdefault(notice_key, {})
-        confirmed[notice_key].update({"source_channel": source_channel_id})
-        save_confirmed()
+        confirmed[notice_key].update({"source_channel": source_channel_id, "guild": guild.id, "level": level})
+        save_confirmed(notice_key)
 
     embed = discord.Embed(title="📢 人数確定通知",
                           description=(f"日程: {date_str}\n級: {level}\n参加者 ({len(participants)}人): {participants_list}\n\n{mention} さん、開催可否を選択してください。"))
     view = ConfirmViewWithImage(level, date_str, notice_key=notice_key)
-    await confirm_channel.send(embed=embed, view=view)
+    msg = await channel_send(confirm_channel, PRIO_NOTICE, embed=embed, view=view)
+    if notice_key:
+        # 再起動後にボタンを復元するため通知メッセージの ID を残す
+        load_confirmed()
+        confirmed.setdefault(notice_key, {})["notice_message"] = msg.id
+        save_confirmed(notice_key)
+
+# -----------------------------
+# 永続 View の復元
+# 再起動後も既存メッセージのボタンが動くよう、アクティブな投票メッセージと
+# 未確定の人数確定通知だけ View を登録し直す (過去の週はアーカイブ済みなので対象外)。
+# custom_id を持たない以前の形式のメッセージは復元できないので、Step1 で投稿し直す。
+# -----------------------------
+restored_views = set()   # View を登録済みの message_id
+
+
+def restore_persistent_views():
+    count = 0
+    today = today_jst()
+    for msg_id in vote_index.messages_since(archive_week_key(retention_cutoff(today))):
+        if msg_id in restored_views:
+            continue
+        entry = vote_data[msg_id]
+        dates = [d for d in entry_dates(entry) if is_active_date(d, today)]
+        if not dates:
+            continue
+        bot.add_view(VoteView(dates[0]), message_id=int(msg_id))
+        restored_views.add(msg_id)
+        count += 1
+    load_confirmed()
+    for key, info in confirmed.items():
+        notice_id = info.get("notice_message")
+        if not notice_id or info.get("final") or str(notice_id) in restored_views:
+            continue
+        date_str = key.split("|", 1)[1] if "|" in key else ""
+        bot.add_view(ConfirmViewWithImage(info.get("level", UNKNOWN_LEVEL), date_str, notice_key=key), message_id=int(notice_id))
+        restored_views.add(str(notice_id))
+        count += 1
+    return count
+
+# -----------------------------
+# スラッシュコマンドの同期
+# コマンド定義のハッシュが前回の同期時と同じなら tree.sync() を呼ばない
+# -----------------------------
+COMMAND_HASH_FILE = os.path.join(DATA_DIR, "command_hash.txt")
+
+
+def command_signature():
+    payload = sorted((cmd.to_dict(tree) for cmd in tree.get_commands()), key=lambda c: c["name"])
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+async def sync_commands_if_changed():
+    signature = command_signature()
+    try:
+        with open(COMMAND_HASH_FILE, "r", encoding="utf-8") as f:
+            previous = f.read().strip()
+    except FileNotFoundError:
+        previous = None
+    if signature == previous:
+        print("✅ Slash Commands 変更なし (同期をスキップ)")
+        return False
+    await tree.sync()
+    write_json_atomic(COMMAND_HASH_FILE, signature)
+    print(f"✅ Slash Commands synced!")
+    return True
 
 # -----------------------------
 # /place コマンド
 # -----------------------------
 @tree.command(name="place", description="スタジオを管理します（登録/削除/一覧）")
 @app_commands.describe(action="操作: 登録 / 削除 / 一覧", name="スタジオ名（登録/削除時に指定）")
+@instrumented("place")
 async def manage_location(interaction: discord.Interaction, action: str, name: str = None):
     action = action.strip()
     load_locations()
+    guild_id = interaction.guild.id if interaction.guild else None
     if action in ("登録", "削除") and (not name or name.strip() == ""):
-        await interaction.response.send_message("⚠️ 登録・削除時は必ずスタジオ名を指定してください。", ephemeral=True)
+        await reply(interaction, "⚠️ 登録・削除時は必ずスタジオ名を指定してください。", ephemeral=True)
         return
     if action == "登録":
-        locations.setdefault("共通", [])
-        if name in locations["共通"]:
-            await interaction.response.send_message(f"⚠️ {name} は既に登録済みです。", ephemeral=True)
+        if name in guild_locations(guild_id):
+            await reply(interaction, f"⚠️ {name} は既に登録済みです。", ephemeral=True)
             return
-        locations["共通"].append(name)
+        guild_locations(guild_id, create=True).append(name)
         save_locations()
-        await interaction.response.send_message(f"✅ {name} を登録しました。", ephemeral=True)
+        await reply(interaction, f"✅ {name} を登録しました。", ephemeral=True)
     elif action == "削除":
-        if name not in locations.get("共通", []):
-            await interaction.response.send_message(f"⚠️ {name} は登録されていません。", ephemeral=True)
+        if name not in guild_locations(guild_id):
+            await reply(interaction, f"⚠️ {name} は登録されていません。", ephemeral=True)
             return
-        locations["共通"].remove(name)
+        guild_locations(guild_id, create=True).remove(name)
         save_locations()
-        await interaction.response.send_message(f"✅ {name} を削除しました。", ephemeral=True)
+        await reply(interaction, f"✅ {name} を削除しました。", ephemeral=True)
     elif action == "一覧":
-        loc_list = "\n".join(locations.get("共通", [])) or "未登録"
-        await interaction.response.send_message(f"📃 登録スタジオ一覧:\n{loc_list}", ephemeral=True)
+        loc_list = "\n".join(guild_locations(guild_id)) or "未登録"
+        await reply(interaction, f"📃 登録スタジオ一覧:\n{loc_list}", ephemeral=True)
     else:
-        await interaction.response.send_message("⚠️ action は 登録 / 削除 / 一覧 のいずれかを指定してください。", ephemeral=True)
+        await reply(interaction, "⚠️ action は 登録 / 削除 / 一覧 のいずれかを指定してください。", ephemeral=True)
 
 # -----------------------------
 # Scheduler (本番: 毎週日曜 9:00 に Step1)
+# - 各週の日程は 3 週前に Step1 で投稿、2 週前に Step2 で状況通知、1 週前に Step3 で催促する。
+#   ジョブは毎週同じ日曜に続けて動くが、Step2/3 は STEP2/3_WEEKS_AHEAD 週後の日程だけを扱う
+#   (直前の Step1 で投稿したばかりの日程には通知・催促しない)
 # - ただし、テスト目的で管理者が即時実行できるコマンドを用意
+# - ジョブは data/jobs.sqlite3 に保存し、再起動しても次回の実行予定が残る。
+#   停止中に過ぎた実行は、起動時に STEP_MISFIRE_GRACE_SEC 以内なら 1 回だけ (coalesce) 実行する
 # -----------------------------
-scheduler = AsyncIOScheduler(timezone=JST)
+JOBS_FILE = os.path.join(DATA_DIR, "jobs.sqlite3")
+STEP_CRONS = {
+    "step1": os.getenv("STEP1_CRON", "0 9 * * sun"),
+    "step2": os.getenv("STEP2_CRON", "5 9 * * sun"),
+    "step3": os.getenv("STEP3_CRON", "10 9 * * sun"),
+    "retention": os.getenv("RETENTION_CRON", "0 4 * * *"),   # 過ぎた週をアーカイブへ移動
+}
+STEP_MISFIRE_GRACE_SEC = int(os.getenv("STEP_MISFIRE_GRACE_SEC", "86400"))
+STEP2_WEEKS_AHEAD = int(os.getenv("STEP2_WEEKS_AHEAD", "2"))
+STEP3_WEEKS_AHEAD = int(os.getenv("STEP3_WEEKS_AHEAD", "1"))
+
+
+class SQLiteJobStore(BaseJobStore):
+    # APScheduler のジョブ (pickle した状態) を SQLite に保存する。SQLAlchemyJobStore と同じ形で標準ライブラリだけを使う
+    def __init__(self, path=JOBS_FILE, pickle_protocol=pickle.HIGHEST_PROTOCOL):
+        super().__init__()
+        self.path = path
+        self.pickle_protocol = pickle_protocol
+        self.db = None
+
+    def start(self, scheduler, alias):
+        super().start(scheduler, alias)
+        self.db = sqlite3.connect(self.path)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, next_run_time REAL, job_state BLOB NOT NULL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_next_run_time ON jobs (next_run_time)")
+
+    def _restore(self, job_state):
+        job = Job.__new__(Job)
+        job.__setstate__(pickle.loads(job_state))
+        job._scheduler = self._scheduler
+        job._jobstore_alias = self._alias
+        return job
+
+    def _select(self, where="", params=()):
+        jobs, broken = [], []
+        for job_id, job_state in self.db.execute(
+                f"SELECT id, job_state FROM jobs {where} ORDER BY next_run_time IS NULL, next_run_time", params):
+            try:
+                jobs.append(self._restore(job_state))
+            except Exception:
+                self._logger.exception('Unable to restore job "%s" -- removing it', job_id)
+                broken.append((job_id,))
+        if broken:
+            with self.db:
+                self.db.executemany("DELETE FROM jobs WHERE id = ?", broken)
+        return jobs
+
+    def lookup_job(self, job_id):
+        row = self.db.execute("SELECT job_state FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._restore(row[0]) if row else None
+
+    def get_due_jobs(self, now):
+        return self._select("WHERE next_run_time <= ?", (datetime_to_utc_timestamp(now),))
+
+    def get_next_run_time(self):
+        row = self.db.execute("SELECT MIN(next_run_time) FROM jobs WHERE next_run_time IS NOT NULL").fetchone()
+        return utc_timestamp_to_datetime(row[0]) if row and row[0] is not None else None
+
+    def get_all_jobs(self):
+        jobs = self._select()
+        self._fix_paused_jobs_sorting(jobs)
+        return jobs
+
+    def add_job(self, job):
+        try:
+            with self.db:
+                self.db.execute("INSERT INTO jobs VALUES (?, ?, ?)",
+                                (job.id, datetime_to_utc_timestamp(job.next_run_time),
+                                 pickle.dumps(job.__getstate__(), self.pickle_protocol)))
+        except sqlite3.IntegrityError:
+            raise ConflictingIdError(job.id)
+
+    def update_job(self, job):
+        with self.db:
+            cur = self.db.execute("UPDATE jobs SET next_run_time = ?, job_state = ? WHERE id = ?",
+                                  (datetime_to_utc_timestamp(job.next_run_time),
+                                   pickle.dumps(job.__getstate__(), self.pickle_protocol), job.id))
+        if cur.rowcount == 0:
+            raise JobLookupError(job.id)
+
+    def remove_job(self, job_id):
+        with self.db:
+            cur = self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        if cur.rowcount == 0:
+            raise JobLookupError(job_id)
+
+    def remove_all_jobs(self):
+        with self.db:
+            self.db.execute("DELETE FROM jobs")
+
+    def shutdown(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+scheduler = AsyncIOScheduler(
+    jobstores={"default": SQLiteJobStore()},
+    job_defaults={"coalesce": True, "misfire_grace_time": STEP_MISFIRE_GRACE_SEC, "max_instances": 1},
+    timezone=JST,
+)
+
+
+def ensure_job(job_id, func, trigger):
+    # 保存済みのジョブがあればそのまま使う (次回の実行予定・停止中に過ぎた分を残すため)。
+    # 関数やスケジュールの設定が変わった時だけ置き換える
+    job = scheduler.get_job(job_id)
+    if job is None:
+        scheduler.add_job(func, trigger, id=job_id)
+        return "追加"
+    if job.func_ref != obj_to_ref(func) or repr(job.trigger) != repr(trigger):
+        scheduler.add_job(func, trigger, id=job_id, replace_existing=True)
+        return "更新"
+    if (job.coalesce, job.misfire_grace_time, job.max_instances) != (True, STEP_MISFIRE_GRACE_SEC, 1):
+        job.modify(coalesce=True, misfire_grace_time=STEP_MISFIRE_GRACE_SEC, max_instances=1)
+    return "継続"
+
+
+def start_scheduler():
+    # 一時停止状態で起動してジョブを揃えてから再開する (再開時に過ぎた実行がまとめて判定される)
+    scheduler.start(paused=True)
+    jobs = {"step1": schedule_step1, "step2": schedule_step2, "step3": schedule_step3, "retention": run_retention}
+    for job_id, func in jobs.items():
+        trigger = CronTrigger.from_crontab(STEP_CRONS[job_id], timezone=JST)
+        state = ensure_job(job_id, func, trigger)
+        job = scheduler.get_job(job_id)
+        print(f"✅ ジョブ {job_id} ({STEP_CRONS[job_id]}): {state} / 次回 {job.next_run_time}")
+    scheduler.resume()
+# Step3 のリマインド: digest (既定: チャンネルごとに 1 人 1 回) / per_date (日程ごとに送信)
+REMINDER_MODE = os.getenv("REMINDER_MODE", "digest")
+MESSAGE_LIMIT = 2000
+# 各ステップは全サーバーに対して最大 GUILD_CONCURRENCY 並列で実行する
+GUILD_CONCURRENCY = int(os.getenv("GUILD_CONCURRENCY", "4"))
+
+
+async def run_per_guild(step, guilds=None, **kwargs):
+    guilds = list(bot.guilds if guilds is None else guilds)
+    sem = asyncio.Semaphore(GUILD_CONCURRENCY)
+
+    async def run(guild):
+        async with sem:
+            try:
+                await step(guild, **kwargs)
+            except Exception as e:
+                metrics.inc("guild_step_errors", step=step.__name__)
+                print(f"⚠ {step.__name__} エラー ({guild.name}): {e}")
 
-async def schedule_step1():
+    await asyncio.gather(*(run(g) for g in guilds))
+
+
+@instrumented("step1", kind="job", label="step")
+async def schedule_step1(guilds=None):
     await bot.wait_until_ready()
-    guild = bot.guilds[0]
+    await run_per_guild(step1_for_guild, guilds)
+    print("✅ Step1 完了: チャンネル作成と投票メッセージ送信")
+
+@instrumented("step2", kind="job", label="step")
+async def schedule_step2(guilds=None, weeks_ahead=STEP2_WEEKS_AHEAD):
+    await bot.wait_until_ready()
+    await run_per_guild(step2_for_guild, guilds, weeks_ahead=weeks_ahead)
+    print("✅ Step2 完了: 投票状況通知送信")
+
+@instrumented("step3", kind="job", label="step")
+async def schedule_step3(guilds=None, weeks_ahead=STEP3_WEEKS_AHEAD):
+    await bot.wait_until_ready()
+    await run_per_guild(step3_for_guild, guilds, weeks_ahead=weeks_ahead)
+    print("✅ Step3 完了: 未投票者へメンション催促")
+
+# Step1 は級ごとに並行して進める。投稿は 1 件ごとに record_vote_message で記録するので、
+# 途中で落ちても再実行すれば投稿済みの日程は飛ばして続きから投稿する (記録前に落ちた分はチャンネル履歴から拾う)
+STEP1_HISTORY_SCAN = 50
+
+
+def level_overwrites(guild, level):
+    # 権限設定: 講師, 初級/中級, 管理者 のみ閲覧
+    overwrites = {guild.default_role: discord.PermissionOverwrite(view_channel=False)}
+    for role_name in ("講師", level, "管理者"):
+        role = role_by_name(guild, role_name)
+        if role:
+            overwrites[role] = discord.PermissionOverwrite(view_channel=True, send_messages=True)
+    return overwrites
+
+
+async def step1_for_guild(guild):
     start = get_schedule_start(weeks_ahead=3)
     week_name = get_week_name(start)
     week = generate_week_schedule(start)
 
-    for cat_name in ["初級", "中級"]:
-        category = discord.utils.get(guild.categories, name=cat_name)
-        ch_name = f"{week_name}-{cat_name}"
-        ch = discord.utils.get(guild.text_channels, name=ch_name)
-        # 権限設定: 講師, 初級/中級, 管理者 のみ閲覧
-        overwrites = {}
-        everyone = guild.default_role
-        overwrites[everyone] = discord.PermissionOverwrite(view_channel=False)
-        role_teacher = role_by_name(guild, "講師")
-        role_level = role_by_name(guild, cat_name)
-        role_admin = role_by_name(guild, "管理者")
-        if role_teacher:
-            overwrites[role_teacher] = discord.PermissionOverwrite(view_channel=True, send_messages=True)
-        if role_level:
-            overwrites[role_level] = discord.PermissionOverwrite(view_channel=True, send_messages=True)
-        if role_admin:
-            overwrites[role_admin] = discord.PermissionOverwrite(view_channel=True, send_messages=True)
-
-        if not ch:
-            ch = await guild.create_text_channel(ch_name, category=category, overwrites=overwrites)
-        else:
-            # 既存があれば権限を更新
+    results = await asyncio.gather(*(step1_for_level(guild, level, week_name, week) for level in LEVELS),
+                                   return_exceptions=True)
+    for r in results:
+        if isinstance(r, Exception):
+            raise r
+
+
+async def step1_for_level(guild, level, week_name, week):
+    category = category_by_name(guild, level)
+    ch_name = f"{week_name}-{level}"
+    ch = text_channel_by_name(guild, ch_name)
+    overwrites = level_overwrites(guild, level)
+
+    if not ch:
+        ch = await api(f"guild:{guild.id}", PRIO_BULK,
+                       lambda: guild.create_text_channel(ch_name, category=category, overwrites=overwrites))
+        posted = set()
+    else:
+        # 既存があれば権限を更新 (同じなら送らない)
+        if ch.overwrites != overwrites:
             try:
-                await ch.edit(overwrites=overwrites)
+                await api(f"ch:{ch.id}", PRIO_BULK, lambda: ch.edit(overwrites=overwrites))
             except Exception:
                 pass
+        posted = {d for msg_id in vote_index.channel_messages(ch.id) for d in entry_dates(vote_data[msg_id])}
+        missing = [d for d in week if d not in posted]
+        if missing:
+            posted |= await adopt_posted_votes(guild, ch, missing, level)
 
-        for date in week:
-            embed = discord.Embed(title=f"📅 {date}")
-            embed.add_field(name="参加(🟢)", value="0人", inline=False)
-            embed.add_field(name="オンライン可(🟡)", value="0人", inline=False)
-            embed.add_field(name="不可(🔴)", value="0人", inline=False)
-            view = VoteView(date)
-            msg = await ch.send(embed=embed, view=view)
-            vote_data[str(msg.id)] = {"channel": ch.id, date: {"参加(🟢)": {}, "オンライン可(🟡)": {}, "不可(🔴)": {}}}
-    save_votes()
-    print("✅ Step1 完了: チャンネル作成と投票メッセージ送信")
-
-async def schedule_step2():
-    await bot.wait_until_ready()
-    # Step1で作成されたメッセージごとに、当該チャンネルのメンバーのみで投票状況表示
-    for msg_id, data in list(vote_data.items()):
-        ch = bot.get_channel(data.get("channel"))
-        if not ch:
+    for date in week:
+        if date in posted:
             continue
-        for date_str, votes in data.items():
-            if date_str == "channel":
-                continue
-            # チャンネル内メンバー
-            members = [m for m in ch.members if not m.bot]
-            participants = votes["参加(🟢)"]
-            online = votes["オンライン可(🟡)"]
-            cannot = votes["不可(🔴)"]
-            embed = discord.Embed(title=f"{ch.name} の投票状況通知です！")
-            embed.add_field(name="日程", value=date_str, inline=False)
-            embed.add_field(name=f"参加者 ({len(participants)}人)", value=("\n".join(participants.values()) if participants else "なし"), inline=False)
-            embed.add_field(name=f"不可 ({len(cannot)}人)", value="表示なし", inline=False)
-            embed.add_field(name=f"オンライン可 ({len(online)}人)", value=("\n".join(online.values()) if online else "なし"), inline=False)
-            await ch.send(embed=embed)
-    print("✅ Step2 完了: 投票状況通知送信")
+        embed = discord.Embed(title=f"📅 {date}")
+        for status in STATUSES:
+            embed.add_field(name=status, value="0人", inline=False)
+        view = VoteView(date)
+        msg = await channel_send(ch, PRIO_BULK, embed=embed, view=view)
+        vote_data[str(msg.id)] = {"channel": ch.id, "guild": guild.id, "level": level, date: VoteRecord()}
+        record_vote_message(str(msg.id), ch.id, date, guild.id, level)
 
-async def schedule_step3():
-    await bot.wait_until_ready()
-    for msg_id, data in list(vote_data.items()):
-        ch = bot.get_channel(data.get("channel"))
-        if not ch:
+
+async def adopt_posted_votes(guild, ch, dates, level):
+    # 投稿したが記録する前に止まった投票メッセージをチャンネルの直近の履歴から探して記録する
+    wanted = {f"📅 {d}": d for d in dates}
+
+    async def recent():
+        return [m async for m in ch.history(limit=STEP1_HISTORY_SCAN)]
+    try:
+        messages = await api(f"ch:{ch.id}", PRIO_BULK, recent)
+    except Exception as e:
+        print(f"⚠ 履歴の取得に失敗しました ({ch.name}): {e}")
+        return set()
+    adopted = set()
+    for msg in reversed(messages):
+        date = wanted.get(msg.embeds[0].title) if msg.embeds else None
+        if date is None or date in adopted or msg.author.id != bot.user.id:
             continue
-        for date_str, votes in data.items():
-            if date_str == "channel":
-                continue
-            # 未投票者 = チャンネル内メンバーのうち、どのステータスにも入っていない
-            voted_ids = set()
-            for v in votes.values():
-                voted_ids.update(v.keys())
-            unvoted = [m for m in ch.members if not m.bot and str(m.id) not in voted_ids]
-            # 除外: 講師ロール、管理者ロール
-            exclude_roles = {"講師", "管理者"}
-            to_mention = []
-            for m in unvoted:
-                if any(r.name in exclude_roles for r in m.roles):
-                    continue
-                to_mention.append(m.mention)
-            if to_mention:
-                await ch.send(f"⏰ リマインド！未投票の方: {', '.join(to_mention)} さん、投票をお願いします！")
-    print("✅ Step3 完了: 未投票者へメンション催促")
+        vote_data[str(msg.id)] = {"channel": ch.id, "guild": guild.id, "level": level, date: VoteRecord()}
+        record_vote_message(str(msg.id), ch.id, date, guild.id, level)
+        bot.add_view(VoteView(date), message_id=msg.id)
+        restored_views.add(str(msg.id))
+        adopted.add(date)
+    if adopted:
+        print(f"✅ Step1 再開: {ch.name} の投稿済み {len(adopted)} 件を記録しました")
+    return adopted
+
+EMBED_FIELD_LIMIT = 1024
+EMBED_MAX_FIELDS = 25
+EMBED_TOTAL_LIMIT = 6000
+
+
+def join_names(names, limit=EMBED_FIELD_LIMIT):
+    names = list(names)
+    if not names:
+        return "なし"
+    text = ", ".join(names)
+    if len(text) <= limit:
+        return text
+    shown = []
+    for i, name in enumerate(names):
+        rest = f" …他{len(names) - i}人"
+        if len(", ".join(shown + [name])) + len(rest) > limit:
+            return ", ".join(shown) + rest
+        shown.append(name)
+    return text[:limit]
+
+
+def build_status_digests(ch, changed, unchanged):
+    # changed: [(date_str, rec)] は日程ごとのフィールド、unchanged は 1 行の要約にまとめる。
+    # Embed の上限 (フィールド数・合計文字数) を超える分は次の Embed に分ける
+    summary = " / ".join(f"{short_date(d)} 参加{rec.counts[YES]}" for d, rec in unchanged)
+    description = f"変更なし: {summary}" if summary else None
+    embeds = []
+    embed = discord.Embed(title=f"{ch.name} の投票状況通知です！", description=description)
+    size = len(embed.title) + len(description or "")
+    for date_str, rec in changed:
+        value = (f"参加 ({rec.counts[YES]}人): {join_names(rec.names(YES), 400)}\n"
+                 f"オンライン可 ({rec.counts[MAYBE]}人): {join_names(rec.names(MAYBE), 400)}\n"
+                 f"不可 ({rec.counts[NO]}人): 表示なし")
+        if len(embed.fields) >= EMBED_MAX_FIELDS or size + len(date_str) + len(value) > EMBED_TOTAL_LIMIT:
+            embeds.append(embed)
+            embed = discord.Embed(title=f"{ch.name} の投票状況通知です！(続き)")
+            size = len(embed.title)
+        embed.add_field(name=date_str, value=value, inline=False)
+        size += len(date_str) + len(value)
+    embeds.append(embed)
+    return embeds
+
+
+async def step2_for_guild(guild, weeks_ahead=None):
+    # チャンネルごとに 1 つの Embed で、前回の通知から変わった日程だけ詳しく、それ以外は要約で表示
+    today = today_jst()
+    per_channel = {}   # ch -> ([(date_str, rec)] 変更あり, [(date_str, rec)] 変更なし, {key: version} 通知に載せる版)
+    for channel_id, msg_id, date_str in target_week_rows(active_channel_dates(guild.id, today), weeks_ahead):
+        ch = bot.get_channel(channel_id)
+        rec = get_vote_record(msg_id, date_str)
+        if not ch or rec is None or ch.guild.id != guild.id:
+            continue
+        changed, unchanged, shown = per_channel.setdefault(ch, ([], [], {}))
+        key = (msg_id, date_str)
+        if digest_versions.get(key) == rec.version:
+            unchanged.append((date_str, rec))
+        else:
+            changed.append((date_str, rec))
+            shown[key] = rec.version
+
+    async def send_digest(ch, embeds, shown):
+        # 送れたチャンネルだけ「通知済み」にする (失敗したら次回も変更ありとして載せる)
+        for embed in embeds:
+            await channel_send(ch, PRIO_BULK, embed=embed)
+        digest_versions.update(shown)
+
+    sends = []
+    for ch, (changed, unchanged, shown) in per_channel.items():
+        changed.sort(key=lambda x: x[0])
+        unchanged.sort(key=lambda x: x[0])
+        sends.append(send_digest(ch, build_status_digests(ch, changed, unchanged), shown))
+    await gather_sends(sends)
+
+def short_date(date_str):
+    # "2025-12-07 (日)" -> "12/7(日)"
+    d = parse_vote_date(date_str)
+    if d is None:
+        return date_str
+    weekday = date_str.split("(")[-1].rstrip(")") if "(" in date_str else ""
+    return f"{d.month}/{d.day}({weekday})" if weekday else f"{d.month}/{d.day}"
+
+
+def chunk_message_lines(header, lines, limit=MESSAGE_LIMIT, sep="\n", repeat_header=False):
+    # header + lines を limit 文字以内のメッセージに詰める。
+    # 続きのメッセージには header を付けない (repeat_header なら続きにも付ける)
+    chunks = []
+    current = header
+    width = limit - len(header) - len(sep) if repeat_header and header else limit
+    for line in lines:
+        if len(line) > width:
+            line = line[:width - 1] + "…"
+        if current and len(current) + len(sep) + len(line) > limit:
+            chunks.append(current)
+            current = f"{header}{sep}{line}" if repeat_header and header else line
+        else:
+            current = f"{current}{sep}{line}" if current else line
+    if current and current != header:
+        chunks.append(current)
+    return chunks
+
+
+async def step3_for_guild(guild, weeks_ahead=None):
+    sends = []
+    today = today_jst()
+    missing = {}   # channel -> {user_id: [date_str, ...]} (digest 用)
+    for channel_id, msg_id, date_str in target_week_rows(active_channel_dates(guild.id, today), weeks_ahead):
+        ch = bot.get_channel(channel_id)
+        rec = get_vote_record(msg_id, date_str)
+        if not ch or rec is None or ch.guild.id != guild.id:
+            continue
+        # 未投票者 = 投票対象メンバー (講師・管理者・bot を除く) のうち、どのステータスにも入っていない
+        unvoted = eligible_voters.get(ch).difference(rec.users)
+        if not unvoted:
+            continue
+        if REMINDER_MODE == "digest":
+            users = missing.setdefault(ch, {})
+            for uid in unvoted:
+                users.setdefault(uid, []).append(date_str)
+            continue
+        to_mention = [f"<@{uid}>" for uid in sorted(unvoted, key=int)]
+        suffix = " さん、投票をお願いします！"
+        for content in chunk_message_lines("⏰ リマインド！未投票の方:", to_mention,
+                                           limit=MESSAGE_LIMIT - len(suffix), sep=" "):
+            sends.append(channel_send(ch, PRIO_BULK, content + suffix))
+
+    # digest: チャンネルごとに、未投票の日程が同じ人をまとめて 1 人 1 回だけメンションし、文字数上限で分割する。
+    # 1 行に収まらない人数なら次の行にも日程を付け、行の長さは見出しと一緒に送れる長さまでにする
+    header = "⏰ リマインド！未投票の日程があります。投票をお願いします！"
+    for ch, users in missing.items():
+        groups = {}
+        for uid, dates in users.items():
+            groups.setdefault(tuple(sorted(dates)), []).append(uid)
+        lines = []
+        for dates, uids in sorted(groups.items(), key=lambda kv: (-len(kv[0]), kv[0])):
+            prefix = f"📅 {', '.join(short_date(d) for d in dates)}:"
+            mentions = [f"<@{uid}>" for uid in sorted(uids, key=int)]
+            lines.extend(chunk_message_lines(prefix, mentions, limit=MESSAGE_LIMIT - len(header) - 1,
+                                             sep=" ", repeat_header=True))
+        for content in chunk_message_lines(header, lines):
+            sends.append(channel_send(ch, PRIO_BULK, content))
+    await gather_sends(sends)
 
 # Step4 はスケジューラで自動実行しない（投票によって人数確定通知が出るタイミングで人数確定通知所へ送信）
 
@@ -478,65 +3377,135 @@ async def schedule_step3():
 async def run_step(interaction: discord.Interaction, step: int):
     # 管理者チェック
     if not has_admin_privilege(interaction.user):
-        await interaction.response.send_message("⚠️ このコマンドは管理者のみ実行できます。", ephemeral=True)
+        await reply(interaction, "⚠️ このコマンドは管理者のみ実行できます。", ephemeral=True)
         return
-    await interaction.response.send_message(f"実行を受け付けました: Step{step}", ephemeral=True)
-    if step == 1:
-        await schedule_step1()
-    elif step == 2:
-        await schedule_step2()
-    elif step == 3:
-        await schedule_step3()
-    else:
-        await interaction.followup.send("⚠️ step は 1,2,3 のいずれかを指定してください。", ephemeral=True)
+    # テスト用なので Step2/3 は対象の週に絞らず、保持期間内の全日程を扱う
+    jobs = {1: schedule_step1, 2: functools.partial(schedule_step2, weeks_ahead=None),
+            3: functools.partial(schedule_step3, weeks_ahead=None)}
+    if step not in jobs:
+        await reply(interaction, "⚠️ step は 1,2,3 のいずれかを指定してください。", ephemeral=True)
+        return
+    await reply(interaction, f"実行を受け付けました: Step{step}", ephemeral=True)
+    # コマンドを実行したサーバーだけが対象。定期実行と同じ入口を通すので計測・プロファイルも同じく記録される
+    await jobs[step](guilds=[interaction.guild])
 
-# -----------------------------
-# 実行
-# -----------------------------
-if __name__ == '__main__':
-    bot.run(TOKEN)
+
+@tree.command(name="metrics", description="管理者向け: 処理時間・エラー・API 呼び出しの集計を表示")
+async def show_metrics(interaction: discord.Interaction):
+    if not has_admin_privilege(interaction.user):
+        await reply(interaction, "⚠️ このコマンドは管理者のみ実行できます。", ephemeral=True)
+        return
+    lines = ["📊 メトリクス (起動後の累計, p50/p99 はバケット上限での近似)"]
+    for (name, labels), hist in sorted(metrics.histograms.items()):
+        label = ",".join(f"{k}={v}" for k, v in labels)
+        lines.append(f"{name}[{label}] 件数 {hist.count} / 平均 {hist.sum / hist.count * 1000:.0f}ms / "
+                     f"p50 ≤{hist.quantile(0.5) * 1000:.0f}ms / p99 ≤{hist.quantile(0.99) * 1000:.0f}ms")
+    for (name, labels), value in sorted(metrics.counters.items()):
+        label = ",".join(f"{k}={v}" for k, v in labels)
+        lines.append(f"{name}[{label}] {value}")
+    chunks = chunk_message_lines(lines[0], lines[1:]) or [f"{lines[0]}\nまだ記録がありません。"]
+    await reply(interaction, chunks[0], ephemeral=True)
+    for chunk in chunks[1:]:
+        await followup(interaction, chunk, ephemeral=True)
+
+PROFILE_REPLY_TIMEOUT_SEC = 14 * 60   # interaction の followup は 15 分まで
+
+
+@tree.command(name="profile", description="管理者向け: 次の N 回の処理をプロファイルして上位の関数を表示 (0 で中止)")
+@app_commands.describe(calls="計測する呼び出し回数", targets="対象 (例: step2,persist / 省略時は全部)")
+async def profile_command(interaction: discord.Interaction, calls: int = 20, targets: str = None):
+    if not has_admin_privilege(interaction.user):
+        await reply(interaction, "⚠️ このコマンドは管理者のみ実行できます。", ephemeral=True)
+        return
+    if calls <= 0:
+        # 途中まで計測した分があれば書き出す
+        finishing = profiler.arm(0)
+        if finishing is not None:
+            _, summary = await finishing
+        elif profiler.depth:
+            summary = f"実行中の呼び出しが終わり次第 {PROFILE_DIR} に書き出します。"
+        else:
+            summary = "計測中のものはありませんでした。"
+        await reply(interaction, f"⏹ プロファイルを止めました。\n{summary}"[:MESSAGE_LIMIT], ephemeral=True)
+        return
+    names = parse_profile_targets(targets)
+    done = profiler.wait()
+    profiler.arm(calls, names)
+    await reply(interaction, f"⏱ 次の {calls} 回をプロファイルします (対象: {', '.join(names) or '全部'})。", ephemeral=True)
+    try:
+        _, summary = await asyncio.wait_for(done, PROFILE_REPLY_TIMEOUT_SEC)
+    except asyncio.TimeoutError:
+        await followup(interaction, f"⌛ まだ {profiler.remaining} 回残っています。終わると {PROFILE_DIR} に書き出します。", ephemeral=True)
+        return
+    for chunk in chunk_message_lines("", summary.split("\n")):
+        await followup(interaction, chunk, ephemeral=True)
+
+
+@tree.command(name="stats", description="管理者向け: 直近の出欠集計を表示 (メンバー指定でその人の分)")
+@app_commands.describe(member="集計するメンバー (省略時は級・曜日ごとの合計)", weeks="さかのぼる週数")
+@instrumented("stats")
+async def show_stats(interaction: discord.Interaction, member: discord.Member = None,
+                     weeks: app_commands.Range[int, 1, ROLLUP_MAX_WEEKS] = 8):
+    if not has_admin_privilege(interaction.user):
+        await reply(interaction, "⚠️ このコマンドは管理者のみ実行できます。", ephemeral=True)
+        return
+    week_keys = attendance.recent_weeks(max(weeks, 1))
+    span = f"{week_keys[0]}〜{week_keys[-1]}"
+    if member is not None:
+        header = f"📊 {member.display_name} の出欠 (直近 {weeks} 週: {span})"
+        lines = format_rollup(attendance.user_summary(str(member.id), week_keys), STATUSES)
+    else:
+        header = f"📊 級・曜日ごとの出欠 (直近 {weeks} 週: {span})"
+        votes, outcomes = attendance.level_summary(week_keys)
+        lines = format_rollup(votes, STATUSES)
+        if outcomes:
+            lines += ["", "🗓 確定 / 不開催"] + format_rollup(outcomes, OUTCOMES)
+    chunks = chunk_message_lines(header, lines) or [f"{header}\nまだ記録がありません。"]
+    await reply(interaction, chunks[0], ephemeral=True)
+    for chunk in chunks[1:]:
+        await followup(interaction, chunk, ephemeral=True)
 
 # ====== on_ready ======
+startup_done = False
+
+
 @bot.event
 async def on_ready():
-    load_votes()
-    load_locations()
-    load_confirmed()
+    global startup_done
+    # on_ready はゲートウェイに再接続 (再 IDENTIFY) するたびにも呼ばれるので、起動処理は最初の 1 回だけ行う。
+    # データは import 時に読み込み済み
+    if startup_done:
+        print(f"✅ 再接続しました: {bot.user}")
+        return
+    startup_done = True
+
+    restored = restore_persistent_views()
+    if restored:
+        print(f"✅ View 復元: {restored} 件")
+    try:
+        await start_metrics_server()
+    except OSError as e:
+        print(f"⚠ メトリクスの HTTP を開始できませんでした: {e}")
     try:
-        await tree.sync()
-        print(f"✅ Slash Commands synced!")
+        await sync_commands_if_changed()
     except Exception as e:
         print(f"⚠ コマンド同期エラー: {e}")
 
-    now = datetime.datetime.now(JST)
-    three_week_test = now.replace(hour=12, minute=33, second=0, microsecond=0)
-    two_week_test   = now.replace(hour=12, minute=34, second=0, microsecond=0)
-    one_week_test   = now.replace(hour=12, minute=35, second=0, microsecond=0)
-
-    if three_week_test <= now: three_week_test += datetime.timedelta(days=1)
-    if two_week_test   <= now: two_week_test   += datetime.timedelta(days=1)
-    if one_week_test   <= now: one_week_test   += datetime.timedelta(days=1)
-
-    if not scheduler.running:
-        scheduler.start()
-
-    for jid in ("step1", "step2", "step3"):
-        try:
-            if scheduler.get_job(jid):
-                scheduler.remove_job(jid)
-        except Exception:
-            pass
-
-    scheduler.add_job(schedule_step1, trigger=DateTrigger(run_date=three_week_test), id="step1")
-    scheduler.add_job(schedule_step2, trigger=DateTrigger(run_date=two_week_test), id="step2")
-    scheduler.add_job(schedule_step3, trigger=DateTrigger(run_date=one_week_test), id="step3")
+    archive_expired()
+    start_scheduler()
 
     print(f"✅ Logged in as {bot.user}")
-    print(f"✅ Scheduler started. Step1~3 scheduled at: {three_week_test}, {two_week_test}, {one_week_test}")
 
 # ====== Run ======
 if __name__ == "__main__":
-    bot.run(TOKEN)
+    if len(sys.argv) > 1 and sys.argv[1] == "archive":
+        archive_cli(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == "rollups":
+        rollups_cli(sys.argv[2:])
+    else:
+        if not TOKEN:
+            raise RuntimeError("環境変数 DISCORD_BOT_TOKEN を設定してください。")
+        bot.run(TOKEN)
 
 
 